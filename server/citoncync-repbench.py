@@ -0,0 +1,314 @@
+#!/usr/bin/env python2
+
+# Copyright 2014, Citon Computer Corporation
+
+# citoncync-repbench - Build a synthetic CitonCync basepath and time
+#                      citoncync-repreport against it, so performance can be
+#                      measured and compared without production data.
+#
+# Usage:
+#  citoncync-repbench.py generate -b /tmp/bench -C 20 -H 10 -F 500
+#  citoncync-repbench.py run -b /tmp/bench -o results.json
+
+## Imports
+import sys, os, time, random, json, platform, subprocess, tempfile, imp
+import optparse
+
+# Defaults
+REPREPORT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "citoncync-repreport.py")
+BWTESTFILE = "data/.citoncync-test"
+LASTLOGFILE = "data/.citoncync/log/replication.log"
+DROPCACHES = "/proc/sys/vm/drop_caches"
+
+# Minimal repreport config pointed at the synthetic basepath
+CONFTEMPLATE = """[conf]
+instancename = CitonCync-RepBench
+basepath = %(basepath)s
+ignorecusts = [ citoncync, citoncync-server ]
+dirmatch = [\\w\\d]+
+alertfreepercent = 5
+alertfreegb = 10
+alertstale = 129600
+bwtestfile = %(bwtestfile)s
+lastlogfile = %(lastlogfile)s
+"""
+
+# One rsync --stats block as written by citoncync-lib's do_rsync
+STATSTEMPLATE = """
+Number of files: %(files)s (reg: %(files)s, dir: %(dirs)s)
+Number of created files: %(created)s
+Number of deleted files: 0
+Number of regular files transferred: %(xfer)s
+Total file size: %(size)s bytes
+Total transferred file size: %(xsize)s bytes
+Literal data: %(xsize)s bytes
+Matched data: 0 bytes
+File list size: %(flist)s
+File list generation time: 0.001 seconds
+File list transfer time: 0.000 seconds
+Total bytes sent: %(sent)s
+Total bytes received: %(recv)s
+
+sent %(sent)s bytes  received %(recv)s bytes  %(rate)s bytes/sec
+total size is %(size)s  speedup is %(speedup)s
+"""
+
+
+def stamp(t):
+    """
+    Return a citoncync-lib style date stamp for UNIX time t
+    """
+    return time.strftime("%Y-%m-%dT%H:%M:%S+0000", time.gmtime(t))
+
+
+def writeLog(path, user, sources, logsize, rnd):
+    """
+    Write a replication.log for one host with a realistic header, a --stats
+    block per source and roughly logsize KB of rsync chatter
+    """
+
+    now = time.time() - rnd.randint(3600, 20 * 3600)
+    fh = open(path, 'w')
+    try:
+        fh.write("%s Starting replication to %s@target:/data\n" % (stamp(now), user))
+        fh.write("%s Setting upload rate to %dKbps  (50%% of measured)\n" % (stamp(now + 12), rnd.randint(500, 20000)))
+
+        chatter = (logsize * 1024) / max(1, len(sources))
+        for src in sources:
+            fh.write("%s Replicating /srv/data/%s to target:/data/%s\n" % (stamp(now + 13), src, src))
+
+            written = 0
+            n = 0
+            while written < chatter:
+                line = "%s/dir%04d/file%06d.dat\n" % (src, n / 100, n)
+                fh.write(line)
+                written += len(line)
+                n += 1
+
+            size = rnd.randint(10 ** 6, 10 ** 12)
+            sent = rnd.randint(10 ** 3, 10 ** 9)
+            fh.write(STATSTEMPLATE % {
+                'files': "{:,}".format(n),
+                'dirs': "{:,}".format(n / 100 + 1),
+                'created': rnd.randint(0, 100),
+                'xfer': "{:,}".format(rnd.randint(0, n)),
+                'size': "{:,}".format(size),
+                'xsize': "{:,}".format(sent),
+                'flist': "{:,}".format(n * 40),
+                'sent': "{:,}".format(sent),
+                'recv': "{:,}".format(n * 30),
+                'rate': "{:,.2f}".format(sent / 60.0),
+                'speedup': "{:,.2f}".format(float(size) / (sent + (n * 30)))
+            })
+
+            if rnd.random() < 0.1:
+                fh.write("%s (Attempt 1) Replication of %s terminated early with code 23 - Will retry after 60 seconds.\n" % (stamp(now + 30), src))
+            fh.write("%s Replication of %s completed normally\n" % (stamp(now + 60), src))
+
+        fh.write("%s End data replication\n" % stamp(now + 120))
+    finally:
+        fh.close()
+
+    return now
+
+
+def generate(opts):
+    """
+    Build opts.customers x opts.hosts host directories under opts.basepath,
+    each with opts.files files spread over directories opts.depth deep
+    """
+
+    rnd = random.Random(opts.seed)
+
+    for ci in range(opts.customers):
+        cust = "cust%04d" % ci
+        for hi in range(opts.hosts):
+            host = "host%03d" % hi
+            hdir = os.path.join(opts.basepath, cust, host)
+            data = os.path.join(hdir, "data")
+
+            # Spread files over a tree opts.depth levels deep with opts.fanout
+            # subdirectories per level
+            for fi in range(opts.files):
+                parts = [data, "Share"]
+                n = fi
+                for level in range(opts.depth):
+                    parts.append("d%02d" % (n % opts.fanout))
+                    n /= opts.fanout
+                fdir = os.path.join(*parts)
+                if not os.path.isdir(fdir):
+                    os.makedirs(fdir)
+
+                fh = open(os.path.join(fdir, "f%06d" % fi), 'wb')
+                fh.write("x" * rnd.randint(0, opts.filesize))
+                fh.close()
+
+            logdir = os.path.dirname(os.path.join(hdir, LASTLOGFILE))
+            if not os.path.isdir(logdir):
+                os.makedirs(logdir)
+            started = writeLog(os.path.join(hdir, LASTLOGFILE), "%s-%s" % (cust, host), ["Share", "Public"], opts.logsize, rnd)
+
+            bwtest = os.path.join(hdir, BWTESTFILE)
+            open(bwtest, 'w').close()
+            os.utime(bwtest, (started, started))
+
+        print "Generated %s (%d hosts)" % (cust, opts.hosts)
+
+
+def dropCaches():
+    """
+    Try to drop the page cache (Linux, as root).  Returns True on success.
+    """
+
+    try:
+        subprocess.call(["sync"])
+        fh = open(DROPCACHES, 'w')
+        fh.write("3\n")
+        fh.close()
+    except (IOError, OSError):
+        return False
+
+    return True
+
+
+def timeit(func, cold, repeat):
+    """
+    Run func repeat times, dropping caches first if cold is set.  Returns
+    a dictionary of timings or None if a cold run was asked for and caches
+    could not be dropped.
+    """
+
+    times = []
+    for i in range(repeat):
+        if cold and not dropCaches():
+            return None
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+
+    times.sort()
+    return {
+        'min': times[0],
+        'median': times[len(times) / 2],
+        'max': times[-1],
+        'runs': times
+    }
+
+
+def run(opts):
+    """
+    Time repreport functions and whole reports against opts.basepath and
+    write JSON results
+    """
+
+    # Load repreport as a module without leaving a .pyc next to it
+    sys.dont_write_bytecode = True
+    rep = imp.load_source("citoncync_repreport", opts.repreport)
+
+    custs = sorted(rep.listCustomers(opts.basepath, r'[\w\d]+', []))
+    hdirs = []
+    for c in custs:
+        for h in sorted(rep.listCustomerHosts(opts.basepath, c, r'[\w\d]+')):
+            hdirs.append(os.path.join(opts.basepath, c, h))
+
+    conffile = tempfile.NamedTemporaryFile(suffix=".conf", delete=False)
+    conffile.write(CONFTEMPLATE % {'basepath': opts.basepath, 'bwtestfile': BWTESTFILE, 'lastlogfile': LASTLOGFILE})
+    conffile.close()
+
+    def report(args):
+        devnull = open(os.devnull, 'w')
+        try:
+            rc = subprocess.call([sys.executable, opts.repreport, "-c", conffile.name] + args, stdout=devnull, stderr=devnull)
+        finally:
+            devnull.close()
+        if rc:
+            raise RuntimeError("citoncync-repreport exited with %d" % rc)
+
+    benches = [
+        ('listCustomers', lambda: rep.listCustomers(opts.basepath, r'[\w\d]+', [])),
+        ('listCustomerHosts', lambda: [rep.listCustomerHosts(opts.basepath, c, r'[\w\d]+') for c in custs]),
+        ('getUsedSpace', lambda: [rep.getUsedSpace(d) for d in hdirs]),
+        ('getLastRate', lambda: [rep.getLastRate(d, LASTLOGFILE) for d in hdirs]),
+        ('report-fast', lambda: report(["-f", "-j", str(opts.jobs)])),
+        ('report-full', lambda: report(["-j", str(opts.jobs)]))
+    ]
+
+    results = {
+        'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'label': opts.label,
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'scandir': rep.scandir is not None,
+        'basepath': opts.basepath,
+        'customers': len(custs),
+        'hosts': len(hdirs),
+        'jobs': opts.jobs,
+        'repeat': opts.repeat,
+        'benchmarks': []
+    }
+
+    try:
+        for (name, func) in benches:
+            for cache in ['cold', 'warm']:
+                # Warm up once so warm numbers really are warm
+                if cache == 'warm':
+                    func()
+                timing = timeit(func, cache == 'cold', opts.repeat)
+                if timing is None:
+                    print >> sys.stderr, "%-18s %-4s skipped (unable to drop caches - run as root on Linux)" % (name, cache)
+                else:
+                    print >> sys.stderr, "%-18s %-4s %10.4fs (median)" % (name, cache, timing['median'])
+                results['benchmarks'].append({'name': name, 'cache': cache, 'timing': timing})
+    finally:
+        os.remove(conffile.name)
+
+    out = json.dumps(results, indent=1, sort_keys=True)
+    if opts.output:
+        fh = open(opts.output, 'w')
+        fh.write(out + "\n")
+        fh.close()
+    else:
+        print out
+
+
+def main():
+    progname = os.path.basename(__file__)
+    parser = optparse.OptionParser(usage="%s generate|run -b BASEPATH [options]" % progname)
+    parser.add_option("-b", "--basepath", dest="basepath", help="synthetic basepath to build or benchmark", metavar="DIR")
+
+    group = optparse.OptionGroup(parser, "generate options")
+    group.add_option("-C", "--customers", dest="customers", type="int", default=10, help="number of customers (default %default)")
+    group.add_option("-H", "--hosts", dest="hosts", type="int", default=5, help="hosts per customer (default %default)")
+    group.add_option("-F", "--files", dest="files", type="int", default=1000, help="files per host (default %default)")
+    group.add_option("--depth", dest="depth", type="int", default=3, help="directory depth under each share (default %default)")
+    group.add_option("--fanout", dest="fanout", type="int", default=8, help="subdirectories per level (default %default)")
+    group.add_option("--filesize", dest="filesize", type="int", default=4096, help="maximum file size in bytes (default %default)")
+    group.add_option("--logsize", dest="logsize", type="int", default=512, help="approximate replication.log size in KB (default %default)")
+    group.add_option("--seed", dest="seed", type="int", default=1, help="random seed (default %default)")
+    parser.add_option_group(group)
+
+    group = optparse.OptionGroup(parser, "run options")
+    group.add_option("-o", "--output", dest="output", help="write JSON results to FILE (default stdout)", metavar="FILE")
+    group.add_option("-l", "--label", dest="label", default="", help="label to store with the results")
+    group.add_option("-r", "--repeat", dest="repeat", type="int", default=3, help="runs per benchmark (default %default)")
+    group.add_option("-j", "--jobs", dest="jobs", type="int", default=1, help="--jobs for whole reports (default %default)")
+    group.add_option("--repreport", dest="repreport", default=REPREPORT, help="citoncync-repreport.py to benchmark", metavar="FILE")
+    parser.add_option_group(group)
+
+    (opts, args) = parser.parse_args()
+
+    if len(args) != 1 or args[0] not in ('generate', 'run'):
+        parser.error("Give one command: generate or run")
+    if not opts.basepath:
+        parser.error("A basepath (-b) is required")
+
+    if args[0] == 'generate':
+        generate(opts)
+    else:
+        if not os.path.isdir(opts.basepath):
+            parser.error("%s does not exist - Run generate first" % opts.basepath)
+        run(opts)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,7 +10,26 @@
 
 ## Imports
 # General
-import sys, os, stat, errno, traceback, time, re, datetime, platform
+import sys, os, stat, errno, traceback, time, re, datetime, platform, socket
+import subprocess, shlex, calendar, random, math, array
+
+# Concurrent host stat collection
+import threading, Queue  # XXX - Change this to "queue" for Python 3
+import _strptime  # Python 2 time.strptime is not thread safe until loaded
+
+# Usage index storage
+import marshal, zlib
+
+# Fast directory listing - scandir is built in for Python 3.5+ and is
+# available as the "scandir" module for Python 2.  Without it we fall back to
+# listdir plus one lstat per entry.
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 # Configuration
 import ConfigParser     # XXX - Change this to "configparser" for Python 3
@@ -19,11 +38,53 @@ import optparse
 # Reporting to console and via email with optional CSV output
 import smtplib, email, logging, logging.handlers, csv
 
+# Historical stats
+import sqlite3
+
+# Daemon mode - Local HTTP report server, with inotify if pyinotify is
+# installed (polling otherwise)
+import BaseHTTPServer, SocketServer, json, StringIO
+
+# Phase timing and metrics output
+import contextlib, tempfile
+
+# Agent snapshots and aggregation
+import gzip, heapq, itertools, struct
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
 # Defaults
 CONFFILE = "/etc/citoncync-repreport.conf"  # Default config file for repreport
+SNAPSHOTVERSION = 1     # Bump when the snapshot record format changes
+MANIFESTVERSION = 1     # Run manifest format written by citoncync-lib
+BLOCKSIZE = 1024        # Hosts evaluated and written out at a time
+ESTIMATEDISTINCT = 3    # Distinct probe results needed to trust an estimate's margin
+LINKSPILL = 250000      # Hardlinked inodes held in memory per walk before spilling
 RATEREGEX = 'Setting upload rate to (\d+)Kbps\s+\((\d+)\% of measured'
 TIMEFORMAT = "%Y-%m-%d %H:%M:%S"
 
+# citoncync-lib replication.log lines - Each starts with an RFC3339 stamp
+LOGSTAMPREGEX = re.compile(r'^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)([+-]\d{4})?\s+(.*)$')
+LOGSTARTREGEX = re.compile(r'^Starting replication to ')
+LOGRATEREGEX = re.compile(RATEREGEX)
+LOGNORATEREGEX = re.compile(r'^(Unable to estimate bandwidth|Replicating )')
+LOGDONEREGEX = re.compile(r'^Replication of (.+) completed normally')
+LOGRETRYREGEX = re.compile(r'^\(Attempt (\d+)\) Replication of (.+) terminated early with code (\d+)')
+LOGENDREGEX = re.compile(r'^End data replication')
+
+# rsync --stats totals we collect, by line prefix.  Older rsyncs say "Number
+# of files transferred", 3.1+ adds "regular" and thousands separators.
+STATSFIELDS = [
+    ('Number of regular files transferred:', 'files'),
+    ('Number of files transferred:', 'files'),
+    ('Total file size:', 'totalsize'),
+    ('Total bytes sent:', 'sent'),
+    ('Total bytes received:', 'received')
+]
+INDEXMAGIC = "CITONCYNC-USAGEINDEX 1\n"  # Header/version line for index files
+
 # Define our report column IDs - These will be posted at the top of CSV
 # output in the order defined
 COLNAMES = [
@@ -37,7 +98,13 @@ COLNAMES = [
     'Last Completed Time',
     'Last Rate Limit',
     'Last Rate %',
-    'Alert Flags'
+    'Alert Flags',
+    'Last Sent Bytes',
+    'Growth Bytes/Day',
+    'Days Until Full',
+    'Rate Trend %',
+    'Host Used Margin Bytes',
+    'Host Disk Bytes'
 ]
 
 
@@ -46,6 +113,146 @@ COLNAMES = [
 humansize = lambda s:[(s%1024**i and "%.1f"%(s/1024.0**i) or str(s/1024**i))+x.strip() for i,x in enumerate(' KMGTPEZY') if s<1024**(i+1) or i==8][0]
 
 
+class HostProfile(object):
+    """
+    Per-host share of the RunStats numbers, kept only with --profile
+    """
+
+    def __init__(self, customer, host):
+        self.customer = customer
+        self.host = host
+        self.seconds = 0.0
+        self.phases = {}
+        self.counts = {}
+
+    def asDict(self):
+        return {
+            'customer': self.customer,
+            'host': self.host,
+            'seconds': self.seconds,
+            'phases': self.phases,
+            'counts': self.counts
+        }
+
+
+class RunStats(object):
+    """
+    Wall time per report phase plus counts of filesystem calls made (stat,
+    statvfs, listdir, open) and of directories and files visited.  Shared
+    by all worker threads, so phases worked on by several threads at once
+    add up to more than the elapsed time.
+
+    With profiling enabled, the same numbers are also kept per host for
+    work done inside a host() block.  Disabled, the per-host hooks are a
+    single attribute test.
+    """
+
+    def __init__(self):
+        self.phases = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+
+        self.profiling = False
+        self.hostprofiles = {}
+        self.local = threading.local()
+
+    def current(self):
+        """
+        Return the HostProfile being worked on by this thread, if any
+        """
+        return getattr(self.local, 'host', None)
+
+    def count(self, name, n=1):
+        """
+        Add n calls to the named counter
+        """
+
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+        if self.profiling:
+            hp = self.current()
+            if hp is not None:
+                hp.counts[name] = hp.counts.get(name, 0) + n
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Context manager adding the wall time of its block to the named phase
+        """
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            secs = time.time() - start
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0.0) + secs
+
+            if self.profiling:
+                hp = self.current()
+                if hp is not None:
+                    hp.phases[name] = hp.phases.get(name, 0.0) + secs
+
+    @contextlib.contextmanager
+    def host(self, customer, host):
+        """
+        Context manager charging the block's time and counts to a host
+        when profiling
+        """
+
+        if not self.profiling:
+            yield
+            return
+
+        key = (customer, host)
+        with self.lock:
+            hp = self.hostprofiles.get(key)
+            if hp is None:
+                hp = HostProfile(customer, host)
+                self.hostprofiles[key] = hp
+
+        self.local.host = hp
+        start = time.time()
+        try:
+            yield
+        finally:
+            hp.seconds += time.time() - start
+            self.local.host = None
+
+    def profile(self):
+        """
+        Return everything collected as a dictionary, slowest hosts first
+        """
+
+        hosts = sorted(self.hostprofiles.values(), key=lambda hp: hp.seconds, reverse=True)
+
+        return {
+            'phases': self.phases,
+            'counts': self.counts,
+            'hosts': [hp.asDict() for hp in hosts]
+        }
+
+    def topHosts(self, n):
+        """
+        Return a text table of the n slowest hosts
+        """
+
+        cols = ['walk', 'statvfs', 'logparse', 'render']
+        lines = ["%-40s %9s %9s %9s %9s %9s %9s %9s %7s %7s" % tuple(['Host', 'Total'] + cols + ['Dirs', 'Files', 'Stats', 'Opens'])]
+        for hp in sorted(self.hostprofiles.values(), key=lambda hp: hp.seconds, reverse=True)[:n]:
+            lines.append("%-40s %9.3f %9.3f %9.3f %9.3f %9.3f %9d %9d %7d %7d" % tuple(
+                ["%s/%s" % (hp.customer, hp.host), hp.seconds] +
+                [hp.phases.get(col, 0.0) for col in cols] +
+                [hp.counts.get(item, 0) for item in ['dirs', 'files', 'stat', 'open']]))
+
+        return "\n".join(lines)
+
+
+# Stats for this run
+RUNSTATS = RunStats()
+
+
 def listCustomers (basepath,dirmatch,ignorecusts):
     """
     List customer parent directories under basepath, ignoring anything that
@@ -56,15 +263,16 @@ def listCustomers (basepath,dirmatch,ignorecusts):
     customers = []
     pat = re.compile(r'^%s$' % dirmatch)
 
-    for cust in os.listdir(basepath):
+    for entry in scanDir(basepath):
+        cust = entry.name
         try:
-            # Try to stat the entity - One time only
-            s = os.stat(os.path.join(basepath, cust))
+            # Only check directories - Usually answered from the directory
+            # entry itself without a stat
+            isdir = entry.is_dir()
         except os.error, err:
             continue
         
-        # Only check directories
-        if stat.S_ISDIR(s.st_mode):
+        if isdir:
             # Now make sure the pattern matches for the customer name 
             m = pat.search(cust)
             if m:
@@ -83,15 +291,15 @@ def listCustomerHosts (basepath,customer,dirmatch):
     hostdirs = []
     pat = re.compile(r'^%s$' % dirmatch)
 
-    for hostn in os.listdir(os.path.join(basepath, customer)):
+    for entry in scanDir(os.path.join(basepath, customer)):
+        hostn = entry.name
         try:
-            # Try to stat the entity - One time only
-            s = os.stat(os.path.join(basepath, customer, hostn))
+            # Only check directories
+            isdir = entry.is_dir()
         except os.error, err:
             continue
         
-        # Only check directories
-        if stat.S_ISDIR(s.st_mode):
+        if isdir:
             # Check the name
             m = pat.search(hostn)
             if m:
@@ -100,26 +308,118 @@ def listCustomerHosts (basepath,customer,dirmatch):
     return hostdirs
 
 
-def getAllocSpace(folder):
-    """ 
-    Return folder/drive quota space (in bytes) - UNIX Only
+class ListDirEntry(object):
+    """
+    Minimal stand-in for scandir's DirEntry, used when scandir is not
+    available.  Stat results are looked up lazily and cached, so callers pay
+    for at most one lstat (plus one stat when following a symlink).
+    """
+
+    def __init__(self, dirpath, name):
+        self.name = name
+        self.path = os.path.join(dirpath, name)
+        self._lstat = None
+
+    def stat(self, follow_symlinks=True):
+        if self._lstat is None:
+            self._lstat = os.lstat(self.path)
+        if follow_symlinks and stat.S_ISLNK(self._lstat.st_mode):
+            return os.stat(self.path)
+        return self._lstat
+
+    def is_dir(self, follow_symlinks=True):
+        try:
+            return stat.S_ISDIR(self.stat(follow_symlinks).st_mode)
+        except os.error, err:
+            return False
+
+    def is_symlink(self):
+        return stat.S_ISLNK(self.stat(False).st_mode)
+
+
+def scanDir(path):
+    """
+    Return a list of directory entries for path, using scandir when it is
+    available so file types come from the directory entry (d_type) without
+    an extra stat call.  Raises os.error if path can not be listed.
+    """
+
+    RUNSTATS.count('listdir')
+
+    if scandir is not None:
+        return list(scandir(path))
+
+    return [ListDirEntry(path, name) for name in os.listdir(path)]
+
+
+def checkFreeAlerts(alloc, free, sets):
+    """
+    Test allocated/free bytes against the alertfreepercent and alertfreegb
+    thresholds.  Returns a (freepercent, alertfreepercent, alertfreegb)
+    tuple.
     """
-    return os.statvfs(folder).f_blocks * os.statvfs(folder).f_frsize
+
+    freepercent = int((100 * free) / alloc)
+
+    return (
+        freepercent,
+        freepercent <= int(sets['alertfreepercent']),
+        free <= (int(sets['alertfreegb']) * 1024 * 1024 * 1024)
+        )
 
 
-def getFreeSpace(folder):
-    """ 
-    Return folder/drive free space (in bytes) - UNIX Only
+def readMountTable():
     """
-    return os.statvfs(folder).f_bfree * os.statvfs(folder).f_frsize
+    Return a set of mountpoints from the system mount table, or None if the
+    table can not be read.  Uses /proc/self/mounts on Linux and "mount -p"
+    on FreeBSD/FreeNAS.
+    """
+
+    try:
+        fh = open('/proc/self/mounts', 'r')
+        try:
+            lines = fh.read().splitlines()
+        finally:
+            fh.close()
+    except IOError:
+        try:
+            lines = subprocess.check_output(['mount', '-p']).splitlines()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    mounts = set()
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 2:
+            continue
+
+        # Linux escapes spaces and friends in octal (\040)
+        mounts.add(re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), fields[1]))
+
+    return mounts
 
 
-def getUsedSpace(folder):
+def getUsedSpace(folder, index=None, deadline=None, tally=None):
     """
     Return the number of bytes used by files under a specific folder.  Uses
     a hacked version of the os.walk code that tracks file sizes on the way
-    to avoid multiple stat calls.
+    to avoid multiple stat calls.  If a UsageIndex is passed, unchanged
+    directories are answered from it instead, and a deadline may be given
+    (see UsageIndex.usedSpace).
+
+    If a LinkTally is passed every file is fed to it and an (apparent
+    bytes, allocated bytes) tuple is returned instead, counting each inode
+    once.  The index is not used then, as its cached directory subtotals
+    say nothing about which inodes other directories link to.
     """
+    if tally is not None:
+        for root, dirs, files, sizes in walksize(folder, tally):
+            pass
+        return tally.total()
+
+    if index is not None:
+        return index.usedSpace(folder, deadline)
+
     s = 0
     for root, dirs, files, sizes in walksize(folder):
         s += sizes
@@ -127,11 +427,239 @@ def getUsedSpace(folder):
     return s
 
 
-def walksize(top):
+class LinkTally(object):
+    """
+    Usage totals that count each (st_dev, st_ino) once, for "unique" usage
+    accounting.  Both the apparent size (st_size) and the space allocated
+    on disk (st_blocks, so sparse and compressed files count for what they
+    really take) are added up.
+
+    Files with a single link are added to the totals straight away.  Files
+    with more links are kept in a per-device {inode: (size, allocated)}
+    dictionary until spill of them are pending.  Then they are written out
+    as a sorted run to an unnamed temporary file in tmpdir, so memory stays
+    bounded however many hardlinks a host has (rsync --link-dest snapshot
+    layouts can have tens of millions).  total() merges the runs (heapq.merge
+    plus groupby, as for snapshots) to count each inode once.
+    """
+
+    RECORD = struct.Struct('<QQQQ')     # dev, inode, size, allocated
+
+    def __init__(self, spill=LINKSPILL, tmpdir=None):
+        self.spill = spill
+        self.tmpdir = tmpdir
+        self.bytes = 0          # Single link totals
+        self.allocated = 0
+        self.pending = {}       # dev -> {inode: (size, allocated)}
+        self.npending = 0
+        self.runs = []          # Spilled sorted runs
+
+    def add(self, st):
+        """
+        Count a file from its lstat result
+        """
+
+        # Not every platform has st_blocks - Fall back to the apparent size
+        allocated = getattr(st, 'st_blocks', None)
+        if allocated is None:
+            allocated = st.st_size
+        else:
+            allocated *= 512
+
+        if st.st_nlink <= 1:
+            self.bytes += st.st_size
+            self.allocated += allocated
+            return
+
+        inodes = self.pending.setdefault(st.st_dev, {})
+        if st.st_ino not in inodes:
+            inodes[st.st_ino] = (st.st_size, allocated)
+            self.npending += 1
+            if self.npending >= self.spill:
+                self.spillRun()
+
+    def sortedPending(self):
+        """
+        Yield the pending hardlinked inodes as (dev, inode, size, allocated)
+        in sorted order
+        """
+
+        for dev in sorted(self.pending):
+            inodes = self.pending[dev]
+            for ino in sorted(inodes):
+                yield (dev, ino) + inodes[ino]
+
+    def spillRun(self):
+        """
+        Write the pending hardlinked inodes out as a sorted run and forget
+        them
+        """
+
+        RUNSTATS.count('linkspill')
+        fh = tempfile.TemporaryFile(dir=self.tmpdir)
+        pack = self.RECORD.pack
+        chunk = []
+        for rec in self.sortedPending():
+            chunk.append(pack(*rec))
+            if len(chunk) >= 4096:
+                fh.write("".join(chunk))
+                chunk = []
+        fh.write("".join(chunk))
+        fh.seek(0)
+
+        self.runs.append(fh)
+        self.pending = {}
+        self.npending = 0
+
+    def readRun(self, fh):
+        """
+        Yield the records of a spilled run
+        """
+
+        size = self.RECORD.size
+        while True:
+            data = fh.read(size * 4096)
+            if not data:
+                break
+            for offset in xrange(0, len(data), size):
+                yield self.RECORD.unpack_from(data, offset)
+
+    def total(self):
+        """
+        Return (apparent bytes, allocated bytes) with every inode counted
+        once, and release any spilled runs
+        """
+
+        (used, allocated) = (self.bytes, self.allocated)
+        try:
+            merged = heapq.merge(self.sortedPending(), *[self.readRun(fh) for fh in self.runs])
+            for (key, group) in itertools.groupby(merged, lambda rec: rec[:2]):
+                rec = next(group)
+                used += rec[2]
+                allocated += rec[3]
+        finally:
+            self.close()
+
+        return (used, allocated)
+
+    def close(self):
+        for fh in self.runs:
+            fh.close()
+        self.runs = []
+        self.pending = {}
+        self.npending = 0
+
+
+def estimateUsedSpace(folder, probes, rnd=None):
+    """
+    Estimate the bytes and number of files under folder from random probes
+    (Knuth's tree size estimator).  Each probe walks from folder down to a
+    leaf directory, picking one subdirectory at random at each level, and
+    adds up the file bytes seen at each level multiplied by the product of
+    the subdirectory counts above it.  The mean of the probes is an unbiased
+    estimate of the tree total.
+
+    Returns (bytes, margin, files, exact) where margin is the half width of
+    a 95% confidence interval for bytes.  Directory listings are shared
+    between probes, and if the probes end up listing every directory the
+    exact totals are returned with exact set.  Probes that keep landing on
+    the same few paths can agree with each other and still be far off, so
+    with fewer than ESTIMATEDISTINCT distinct probe results the margin is
+    None - The caller should walk the tree instead.
+    """
+
+    if rnd is None:
+        rnd = random.Random(folder)
+
+    listings = {}   # path -> (subdirs, file count, file bytes)
+
+    def listing(path):
+        if path not in listings:
+            try:
+                (dirs, nondirs, sizes) = sumEntries(scanDir(path))
+            except os.error, err:
+                (dirs, nondirs, sizes) = ([], [], 0)
+            listings[path] = (dirs, len(nondirs), sizes)
+        return listings[path]
+
+    samples = []
+    counts = []
+    for i in range(probes):
+        path = folder
+        weight = 1
+        total = 0
+        files = 0
+        while True:
+            (dirs, nfiles, sizes) = listing(path)
+            total += weight * sizes
+            files += weight * nfiles
+            if not dirs:
+                break
+            weight *= len(dirs)
+            path = os.path.join(path, rnd.choice(dirs))
+        samples.append(total)
+        counts.append(files)
+
+    # Small trees get fully listed by the probes - Then we know for sure
+    if all(os.path.join(path, d) in listings for (path, (dirs, nfiles, sizes)) in listings.items() for d in dirs):
+        return (sum(l[2] for l in listings.itervalues()), 0, sum(l[1] for l in listings.itervalues()), True)
+
+    n = len(samples)
+    mean = float(sum(samples)) / n
+    variance = sum((x - mean) ** 2 for x in samples) / (n - 1) if n > 1 else mean ** 2
+
+    if len(set(samples)) < ESTIMATEDISTINCT:
+        return (int(mean), None, sum(counts) / n, False)
+
+    return (int(mean), int(1.96 * math.sqrt(variance / n)), sum(counts) / n, False)
+
+
+def sumEntries(entries, tally=None):
+    """
+    Split a list of directory entries into subdirectory and non-directory
+    names and total the (lstat) size of the non-directories.  Returns a
+    (dirnames, filenames, filesizes) tuple.  Entries that vanish or can not
+    be stat'ed are skipped.  The non-directories are also added to tally
+    (a LinkTally) if one is given.
+    """
+
+    dirs, nondirs = [], []
+    sizes = 0
+
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry.name)
+                continue
+
+            # And bump the size!
+            st = entry.stat(follow_symlinks=False)
+            sizes += st.st_size
+            if tally is not None:
+                tally.add(st)
+        except os.error, err:
+            continue
+
+        nondirs.append(entry.name)
+
+    RUNSTATS.count('dirs')
+    RUNSTATS.count('files', len(nondirs))
+
+    # Without scandir every entry costs an lstat, with it only the files do
+    if scandir is None:
+        RUNSTATS.count('stat', len(entries))
+    else:
+        RUNSTATS.count('stat', len(nondirs))
+
+    return dirs, nondirs, sizes
+
+
+def walksize(top, tally=None):
     """
-    This is a direct copy of os.walk from Python2.6 with modifications
-    to create a file size summary as it walks.  topdown, onerror,
-    and followlinks are all negated.
+    Walk the directory tree rooted at top, creating a file size summary as
+    it goes.  Originally a copy of os.walk from Python2.6, now iterative
+    (with an explicit stack, so deep trees can not hit the recursion limit)
+    and built on scanDir.
 
     For each directory in the directory tree rooted at top (including top
     itself, but excluding '.' and '..'), yields a 4-tuple
@@ -144,8 +672,13 @@ def walksize(top):
     and filesizes is a total size in bytes of said files.
 
     Topdown processing is the only direction for walksize.
-    Errors from the os.listdir() call are ignored.
-    walksize does not follow symbolic links.
+    Errors from listing a directory are ignored.
+    walksize does not follow symbolic links - They are counted as
+    non-directory entries using their own (lstat) size.
+
+    Directory entries are typed from d_type where possible, so directories
+    cost no stat at all and each non-directory costs a single lstat.  Every
+    non-directory is also added to tally (a LinkTally) if one is given.
 
     # Example from os.walk modified to use "walksize"
     for root, dirs, files, sizes in walksize('python/Lib/email'):
@@ -156,41 +689,220 @@ def walksize(top):
             dirs.remove('CVS')  # don't visit CVS directories
     """
 
-    # We may not have read permission for top, in which case we can't
-    # get a list of the files the directory contains.  os.path.walk
-    # always suppressed the exception then, rather than blow up for a
-    # minor reason when (say) a thousand readable directories are still
-    # left to visit.  That logic is copied here.
-    try:
-        names = os.listdir(top)
-    
-    except os.error, err:
-        return
+    stack = [top]
 
-    dirs, nondirs = [], []
-    sizes = 0
+    while stack:
+        top = stack.pop()
 
-    for name in names:
+        # We may not have read permission for top, in which case we can't
+        # get a list of the files the directory contains.  os.path.walk
+        # always suppressed the exception then, rather than blow up for a
+        # minor reason when (say) a thousand readable directories are still
+        # left to visit.  That logic is copied here.
         try:
-            # Try to stat the file - One time only
-            s = os.stat(os.path.join(top, name))
+            entries = scanDir(top)
         except os.error, err:
             continue
-        
-        if stat.S_ISDIR(s.st_mode):
-            dirs.append(name)
+
+        dirs, nondirs, sizes = sumEntries(entries, tally)
+
+        yield top, dirs, nondirs, sizes
+
+        # Push in reverse so subdirectories are still visited in listing
+        # order, after the caller has had a chance to prune dirs
+        for name in reversed(dirs):
+            stack.append(os.path.join(top, name))
+
+
+class UsageIndex(object):
+    """
+    Persistent per-host usage index.  Stores, for every directory under a
+    host folder, the directory's inode and mtime along with the total size
+    of the files directly inside it and the names of its subdirectories.
+
+    On the next walk a directory whose inode and mtime are unchanged is not
+    listed again - Its cached subtotal and subdirectory names are reused, so
+    an unchanged tree costs one lstat per directory.  Directories whose
+    mtime moved are rescanned.
+
+    This relies on file changes touching the parent directory mtime, which
+    holds for rsync's default write-to-temp-then-rename behaviour.  Files
+    modified in place (rsync --inplace or --append) are not noticed until
+    the directory changes or the index is rebuilt.
+
+    The file format is the INDEXMAGIC header line followed by a zlib
+    compressed marshal of {relpath: (inode, mtime, bytes, subdirs)}.  Saves
+    go to a temp file that is renamed over the old index, so an interrupted
+    run leaves the previous index intact.
+
+    Walks given a deadline stop when it passes and checkpoint the rest of
+    the walk (directories left to visit, the running total and the entries
+    gathered so far) to a ".ckpt" file next to the index, in the same
+    format.  The next walk resumes from there, so a large host can be
+    covered over several runs.  Directories finished before the checkpoint
+    are not looked at again, so the result is only as current as the
+    oldest part of the walk.
+    """
+
+    def __init__(self, path, rebuild=False):
+        """
+        Load the index stored at path, starting empty if rebuild is set or
+        the file is missing, unreadable or from another format version
+        """
+
+        self.path = path
+        self.ckptpath = path + ".ckpt"
+        self.entries = {}
+        self.mtime = None       # When the index was last completed
+        self.checkpoint = None  # (stack, total, entries) of an unfinished walk
+        self.reused = 0
+        self.rescanned = 0
+
+        if not rebuild:
+            self.entries = self.load(self.path) or {}
+            self.checkpoint = self.load(self.ckptpath)
+            if self.entries:
+                self.mtime = os.path.getmtime(self.path)
+
+    def load(self, path):
+        """
+        Read and return the object stored in an index or checkpoint file, or
+        None on any problem
+        """
+
+        try:
+            fh = open(path, 'rb')
+        except IOError:
+            return None
+
+        try:
+            if fh.readline() != INDEXMAGIC:
+                return None
+            return marshal.loads(zlib.decompress(fh.read()))
+        except (ValueError, EOFError, TypeError, zlib.error):
+            return None
+        finally:
+            fh.close()
+
+    def cachedTotal(self):
+        """
+        Return the total from the last completed walk, or None if there
+        has not been one
+        """
+
+        if not self.entries:
+            return None
+        return sum(entry[2] for entry in self.entries.itervalues())
+
+    def save(self):
+        """
+        Atomically write the index, and the checkpoint of an unfinished
+        walk if there is one, back to disk
+        """
+
+        self.write(self.path, self.entries)
+
+        if self.checkpoint is not None:
+            self.write(self.ckptpath, self.checkpoint)
+        elif os.path.exists(self.ckptpath):
+            os.remove(self.ckptpath)
+
+    def write(self, path, obj):
+        """
+        Atomically write obj to an index format file
+        """
+
+        idxdir = os.path.dirname(self.path)
+        if not os.path.isdir(idxdir):
+            try:
+                os.makedirs(idxdir)
+            except os.error, err:
+                # Another worker may have beaten us to it
+                if err.errno != errno.EEXIST:
+                    raise
+
+        tmppath = "%s.tmp.%d" % (path, os.getpid())
+        try:
+            fh = open(tmppath, 'wb')
+            try:
+                fh.write(INDEXMAGIC)
+                fh.write(zlib.compress(marshal.dumps(obj), 1))
+                fh.flush()
+                os.fsync(fh.fileno())
+            finally:
+                fh.close()
+            os.rename(tmppath, path)
+        except:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+            raise
+
+    def usedSpace(self, folder, deadline=None):
+        """
+        Return the number of bytes used by files under folder, reusing
+        cached subtotals for unchanged directories.  The index is updated in
+        memory to match the tree - Call save() to keep it.
+
+        If deadline (UNIX time) passes first the walk stops, the remaining
+        work is kept as the checkpoint and None is returned.  An existing
+        checkpoint is resumed from.
+        """
+
+        if self.checkpoint is not None:
+            (stack, total, entries) = self.checkpoint
+            self.checkpoint = None
         else:
-            nondirs.append(name)
-            # And bump the size!
-            sizes += s.st_size
+            (stack, total, entries) = ([''], 0, {})
+
+        while stack:
+            if deadline is not None and time.time() >= deadline:
+                self.checkpoint = (stack, total, entries)
+                return None
+
+            rel = stack.pop()
+            path = os.path.join(folder, rel)
+
+            RUNSTATS.count('stat')
+            try:
+                s = os.lstat(path)
+            except os.error, err:
+                continue
+
+            # Something replaced the directory since its parent was cached
+            if not stat.S_ISDIR(s.st_mode):
+                continue
+
+            old = self.entries.get(rel)
+            if old is not None and old[0] == s.st_ino and old[1] == s.st_mtime:
+                (ino, mtime, sizes, subdirs) = old
+                self.reused += 1
+            else:
+                try:
+                    (subdirs, files, sizes) = sumEntries(scanDir(path))
+                except os.error, err:
+                    continue
+                subdirs = tuple(subdirs)
+                self.rescanned += 1
 
-    yield top, dirs, nondirs, sizes
-    
-    for name in dirs:
-        path = os.path.join(top, name)
-        if not os.path.islink(path):
-            for x in walksize(path):
-                yield x
+            entries[rel] = (s.st_ino, s.st_mtime, sizes, subdirs)
+            total += sizes
+
+            for name in subdirs:
+                stack.append(os.path.join(rel, name))
+
+        # Drop directories that no longer exist
+        self.entries = entries
+
+        return total
+
+
+def usageIndexPath(indexdir, basepath, hdir):
+    """
+    Return the usage index file for a host directory - One file per
+    customer/host under indexdir
+    """
+
+    return os.path.join(indexdir, os.path.relpath(hdir, basepath) + ".idx")
 
 
 def getLastChange(folder, subfile):
@@ -201,96 +913,1117 @@ def getLastChange(folder, subfile):
 
     cfile = os.path.join(folder, subfile)
 
+    RUNSTATS.count('stat', 2)
     if not os.path.isfile(cfile):
         return False
 
     return os.path.getmtime(cfile)
 
 
-def getLastRate(folder, lastlogfile):
+def parseDateStamp(stamp, offset=None):
     """
-    Search lastlogfile under folder for a line reporting the bandwidth
-    rate and percentage used for a citoncync run. Returns tuple with bandwidth
-    as element 0 and percentage limit as element 1. 0,0 is returned on error
-    to allow fails to be included in averages, etc without breaking your calcs.
+    Convert a citoncync-lib date stamp (2014-01-02T03:04:05 plus an optional
+    +HHMM/-HHMM offset) to UNIX time.  Stamps without an offset are taken
+    as local time.  Returns None if the stamp can not be parsed.
     """
-    
-    cfile = os.path.join(folder, lastlogfile)
-
-    if not os.path.isfile(cfile):
-        return ('0', '0')
 
     try:
-        lfh = open(cfile, 'r')
-    except OSError:
-        # Skip file
-        return ('0', '0')
-    
-    # Look for our rate line
-    m = re.findall(RATEREGEX, lfh.read())
+        t = time.strptime(stamp, "%Y-%m-%dT%H:%M:%S")
+    except ValueError:
+        return None
 
-    if len(m):
-        return m[0]
-    else:
-        return ('0', '0')
+    if not offset:
+        return time.mktime(t)
 
+    secs = (int(offset[1:3]) * 3600) + (int(offset[3:5]) * 60)
+    if offset[0] == '-':
+        secs = -secs
 
-def timeString(rawdate):
+    return calendar.timegm(t) - secs
+
+
+def parseRunLog(cfile, headeronly=False):
     """
-    Take in a UNIX time and retrun a friendly time string, or "never" if false
+    Read a citoncync-lib replication.log line by line and return a
+    dictionary describing the run:
+
+     start - UNIX time the run started (or None)
+     end - UNIX time data replication ended (or None)
+     ratelimit, ratepercent - Upload rate limit strings ('0' if unset)
+     sources - List of per-source dictionaries with name, code (last exit
+               code, 0 on completion) and attempts
+     files, totalsize, sent, received - rsync --stats totals over all
+               sources
+     speedup - Overall rsync speedup (totalsize / bytes on the wire)
+
+    With headeronly set, reading stops as soon as the start time and rate
+    limit are known, so only the top of the log is touched.  Raises IOError
+    if the log can not be opened.
     """
 
+    run = {
+        'start': None,
+        'end': None,
+        'ratelimit': '0',
+        'ratepercent': '0',
+        'sources': [],
+        'files': 0,
+        'totalsize': 0,
+        'sent': 0,
+        'received': 0,
+        'speedup': 0.0
+    }
+    sources = {}
+
+    RUNSTATS.count('open')
+    lfh = open(cfile, 'r')
     try:
-        if rawdate:
-            stime = time.strftime(TIMEFORMAT, time.localtime(rawdate))
-        else:
-            stime = "never"
-    except:
-        return "never"
+        for line in lfh:
+            m = LOGSTAMPREGEX.match(line)
+            if m is None:
+                # Not one of ours - Check for rsync --stats totals
+                if headeronly:
+                    continue
+
+                for (prefix, field) in STATSFIELDS:
+                    if line.startswith(prefix):
+                        try:
+                            run[field] += int(line[len(prefix):].split()[0].replace(',', ''))
+                        except (ValueError, IndexError):
+                            pass
+                        break
+                continue
+
+            (stamp, offset, msg) = m.groups()
+
+            if LOGSTARTREGEX.match(msg):
+                run['start'] = parseDateStamp(stamp, offset)
+                continue
+
+            m = LOGRATEREGEX.search(msg)
+            if m:
+                (run['ratelimit'], run['ratepercent']) = m.groups()
+                if headeronly:
+                    break
+                continue
+
+            if LOGNORATEREGEX.match(msg):
+                # Past the header without a rate line
+                if headeronly:
+                    break
+                continue
+
+            m = LOGDONEREGEX.match(msg)
+            if m:
+                src = sources.setdefault(m.group(1), {'name': m.group(1), 'code': 0, 'attempts': 0})
+                src['code'] = 0
+                src['attempts'] += 1
+                continue
 
-    return stime
+            m = LOGRETRYREGEX.match(msg)
+            if m:
+                src = sources.setdefault(m.group(2), {'name': m.group(2), 'code': 0, 'attempts': 0})
+                src['code'] = int(m.group(3))
+                src['attempts'] = int(m.group(1))
+                continue
 
+            if LOGENDREGEX.match(msg):
+                run['end'] = parseDateStamp(stamp, offset)
+    finally:
+        lfh.close()
 
-class Configure(ConfigParser.ConfigParser):
+    run['sources'] = sorted(sources.itervalues(), key=lambda src: src['name'])
+
+    if run['sent'] + run['received']:
+        run['speedup'] = float(run['totalsize']) / (run['sent'] + run['received'])
+
+    return run
+
+
+def readRunManifest(cfile):
     """
-    Read and maintain configuration settings - Customized for this program.
-    All supported options must be filtered/copied in by this class
+    Read the run manifest citoncync-lib writes at the end of each run and
+    return it in the same form as parseRunLog(), with 'manifest' set.  The
+    manifest holds start/end times, the rate limit, each source's exit code
+    and attempts and the rsync --stats totals, so the log need not be read.
+    Raises IOError if it can not be opened and ValueError if it is not a
+    manifest we understand.
     """
 
-    def __init__(self):
-        """
-        Read in configuration from command line and config file(s).  Stores
-        a cleaned dictionary called "settings" that should be usable without
-        further processing
-        """
-        ConfigParser.ConfigParser.__init__(self)
+    RUNSTATS.count('open')
+    mfh = open(cfile, 'r')
+    try:
+        doc = json.load(mfh)
+    finally:
+        mfh.close()
 
-        settings = {}
+    if not isinstance(doc, dict) or doc.get('version') != MANIFESTVERSION:
+        raise ValueError("Unknown run manifest format")
 
-        # Parse arguments - XXX - Move this to argparse soon
-        #  Great example of merged ConfigParser/argparse:
-        #  http://blog.vwelch.com/2011/04/combining-configparser-and-argparse.html
-        progname = os.path.basename(__file__)
-        parser = optparse.OptionParser(usage="%s [-c FILE] [-fmwvd]" % progname)
-        parser.add_option("-c", "--config", dest="conffile", help="use configuration from FILE", metavar="FILE")
-        parser.add_option("-f", "--fast", dest="faston", action="store_true", default=False, help="skip per-host usage and other slow stats")
-        parser.add_option("-m", "--mail", dest="emailon", action="store_true", default=False, help="send email report")
-        parser.add_option("-w", "--warn", dest="warnonly", action="store_true", default=False, help="only report when there are hosts with low space or past due replication warnings")
-        parser.add_option("-v", "--csv", dest="csvon", action="store_true", default=False, help="output CSV report")
-        parser.add_option("-d", "--debug", dest="debugon", action="store_true", default=False, help="enable debug mode")
+    try:
+        run = {
+            'manifest': True,
+            'start': float(doc['start']) if doc.get('start') else None,
+            'end': float(doc['end']) if doc.get('end') else None,
+            'ratelimit': str(int(doc.get('ratelimit') or 0)),
+            'ratepercent': str(int(doc.get('ratepercent') or 0)),
+            'sources': sorted([{'name': src['name'], 'code': int(src['code']), 'attempts': int(src['attempts'])} for src in doc.get('sources', [])], key=lambda src: src['name']),
+            'speedup': 0.0
+        }
+        for field in ['files', 'totalsize', 'sent', 'received']:
+            run[field] = int(doc.get(field) or 0)
+    except (KeyError, TypeError), err:
+        raise ValueError("Bad run manifest: %s" % err)
+
+    if run['sent'] + run['received']:
+        run['speedup'] = float(run['totalsize']) / (run['sent'] + run['received'])
+
+    return run
+
+
+def getLastRun(folder, lastlogfile, headeronly=False, manifest=None):
+    """
+    Return the last run for a host as parseRunLog() results, or None if
+    the log is missing or unreadable.  When manifest is given and that file
+    under folder is a readable run manifest it is used instead of the log.
+    """
 
-        # Parse!
-        (options, args) = parser.parse_args()
-        
-        if options.conffile is None:
-            # No config passed, so try the default
-            conffile = CONFFILE
-        else:
-            conffile = options.conffile
+    if manifest:
+        try:
+            return readRunManifest(os.path.join(folder, manifest))
+        except (IOError, ValueError):
+            pass
 
-        if not os.path.isfile(conffile):
-            # This is just a quick check that the config file exists
-            parser.error("Configuration file %s not found" % conffile)
+    cfile = os.path.join(folder, lastlogfile)
+
+    try:
+        return parseRunLog(cfile, headeronly)
+    except IOError:
+        return None
+
+
+def getLastRate(folder, lastlogfile):
+    """
+    Search lastlogfile under folder for a line reporting the bandwidth
+    rate and percentage used for a citoncync run. Returns tuple with bandwidth
+    as element 0 and percentage limit as element 1. 0,0 is returned on error
+    to allow fails to be included in averages, etc without breaking your calcs.
+    """
+    
+    run = getLastRun(folder, lastlogfile, headeronly=True)
+
+    if run is None:
+        return ('0', '0')
+
+    return (run['ratelimit'], run['ratepercent'])
+
+
+def getHostStats(hdir, sets, backend, fscache, walkslot=None):
+    """
+    Gather all stats for a single host directory and return them as a
+    dictionary.  Allocated/free space comes from the shared FsStatsCache
+    snapshot for the host's filesystem, unless the usage backend has more
+    specific numbers for the host.  If walkslot is
+    given it is passed on to the backend to hold only while an expensive
+    usage walk runs, allowing callers to cap the number of concurrent walks
+    against the same device.
+    """
+
+    hstats = {}
+
+    with RUNSTATS.phase('statvfs'):
+        fs = fscache.lookup(hdir)
+    hstats['alloc'] = fs.alloc
+    hstats['free'] = fs.free
+
+    with RUNSTATS.phase('walk'):
+        usage = backend.hostStats(hdir, walkslot)
+    hstats.update(usage)
+
+    # Remember if alloc/free came from the shared filesystem snapshot
+    hstats['fsshared'] = not ('alloc' in usage or 'free' in usage)
+
+    # The run manifest has everything, otherwise fall back to file mtimes
+    # and the log.  The full log is only read for transfer totals when not
+    # in fast mode.
+    with RUNSTATS.phase('logparse'):
+        run = getLastRun(hdir, sets['lastlogfile'], headeronly=sets['skiphostused'], manifest=sets['runmanifest'])
+
+    if run is not None and run.get('manifest'):
+        hstats['laststart'] = run['start'] or False
+        hstats['lastcomplete'] = run['end'] or False
+    else:
+        hstats['laststart'] = getLastChange(hdir, sets['bwtestfile'])
+        hstats['lastcomplete'] = getLastChange(hdir, sets['lastlogfile'])
+
+    if run is None:
+        (hstats['lastratelimit'], hstats['lastratepercent']) = ('0', '0')
+        hstats['lastsent'] = 0
+    else:
+        (hstats['lastratelimit'], hstats['lastratepercent']) = (run['ratelimit'], run['ratepercent'])
+        hstats['lastsent'] = run['sent']
+
+    if sets['skiphostused'] and not (run is not None and run.get('manifest')):
+        hstats['lastsent'] = 'n/a'
+
+    return hstats
+
+
+def alertLimits(sets, c):
+    """
+    Return the alert thresholds for customer c as numbers - The [conf]
+    values with any [customer:NAME] overrides applied
+    """
+
+    limits = {
+        'alertfreepercent': int(sets['alertfreepercent']),
+        'alertfreegb': int(sets['alertfreegb']),
+        'alertstale': float(sets['alertstale']),
+        'alertusedgb': sets['alertusedgb'],
+        'alertdaysfull': sets['alertdaysfull']
+    }
+    limits.update(sets['customers'].get(c, {}))
+
+    return limits
+
+
+# Alert flag bits in HostTable.flags, in report order: (bit, alert text,
+# hoststats item, metrics alert label)
+ALERTBITS = [
+    (0x01, "ALERT-FREE%", 'alertfreepercent', 'free_percent'),
+    (0x02, "ALERT-FREE-GB", 'alertfreegb', 'free_gb'),
+    (0x04, "ALERT-USED-GB", 'alertusedgb', 'used_gb'),
+    (0x08, "ALERT-LATE", 'alertstale', 'stale'),
+    (0x10, "ALERT-DUPLICATE", 'alertduplicate', 'duplicate'),
+    (0x20, "ALERT-FULL-SOON", 'alertdaysfull', 'full_soon')
+]
+DUPLICATEBIT = 0x10
+
+# HostTable.usedstate codes for the hoststats 'hostused'/'usedstate' items
+USEDSTATES = ['exact', 'n/a', 'pending', 'cached', 'estimate']
+
+NAN = float('nan')
+
+
+class HostTable(object):
+    """
+    Columnar store of host stats.  Numbers live in typed arrays (doubles,
+    with NaN for unknown) and customer names are kept once each, so a host
+    costs a few dozen bytes rather than a dictionary.  Alert rules are
+    evaluated for a range of rows in one pass over the columns, using each
+    customer's thresholds (see alertLimits).  Hoststats dictionaries for
+    the renderers are only built by row(), at output time.
+    """
+
+    COLUMNS = ['alloc', 'free', 'used', 'margin', 'files', 'disk', 'laststart', 'lastcomplete', 'lastsent', 'growth', 'daysfull', 'ratetrend']
+
+    def __init__(self):
+        self.custnames = []     # Customer index -> name
+        self.custindex = {}     # Customer name -> index
+        self.nodenames = ['']   # Node index -> name ('' for local)
+        self.nodeindex = {'': 0}
+        self.clear()
+
+    def clear(self):
+        """
+        Drop all rows, keeping the interned names
+        """
+
+        self.cust = array.array('l')
+        self.node = array.array('l')
+        self.host = []
+        for name in self.COLUMNS:
+            setattr(self, name, array.array('d'))
+        self.ratelimit = array.array('l')
+        self.ratepercent = array.array('l')
+        self.usedstate = array.array('B')
+        self.fsshared = array.array('B')
+        self.flags = array.array('B')
+
+    def __len__(self):
+        return len(self.host)
+
+    def intern(self, names, index, name):
+        if name not in index:
+            index[name] = len(names)
+            names.append(name)
+        return index[name]
+
+    def append(self, c, h, hstats):
+        """
+        Add a host and return its row number
+        """
+
+        self.cust.append(self.intern(self.custnames, self.custindex, c))
+        self.node.append(self.intern(self.nodenames, self.nodeindex, hstats.get('node', '')))
+        if isinstance(h, unicode):
+            h = h.encode('utf-8')
+        self.host.append(intern(h))
+        for name in self.COLUMNS:
+            getattr(self, name).append(NAN)
+        self.ratelimit.append(0)
+        self.ratepercent.append(0)
+        self.usedstate.append(0)
+        self.fsshared.append(0)
+        self.flags.append(0)
+
+        i = len(self.host) - 1
+        self.set(i, hstats)
+
+        return i
+
+    def set(self, i, hstats):
+        """
+        Replace the stats of row i, keeping its current alert flags
+        """
+
+        def number(value):
+            if value in (None, 'n/a', 'pending'):
+                return NAN
+            return float(value)
+
+        self.alloc[i] = hstats['alloc']
+        self.free[i] = hstats['free']
+        self.laststart[i] = hstats['laststart'] or 0.0
+        self.lastcomplete[i] = hstats['lastcomplete'] or 0.0
+        self.lastsent[i] = number(hstats['lastsent'])
+        self.ratelimit[i] = int(hstats['lastratelimit'])
+        self.ratepercent[i] = int(hstats['lastratepercent'])
+        self.fsshared[i] = bool(hstats.get('fsshared'))
+
+        self.used[i] = number(hstats['hostused'])
+        if hstats.get('usedstate'):
+            self.usedstate[i] = USEDSTATES.index(hstats['usedstate'])
+        elif hstats['hostused'] == 'n/a':
+            self.usedstate[i] = USEDSTATES.index('n/a')
+        else:
+            self.usedstate[i] = 0
+        self.margin[i] = number(hstats.get('usedmargin'))
+        self.files[i] = number(hstats.get('hostfiles'))
+        self.disk[i] = number(hstats.get('hostdisk'))
+
+        for name in ['growth', 'daysfull', 'ratetrend']:
+            getattr(self, name)[i] = number(hstats.get(name))
+
+        if hstats.get('dupnodes'):
+            self.flags[i] |= DUPLICATEBIT
+
+    def evaluate(self, sets, now, start=0, end=None):
+        """
+        Evaluate the alert rules for rows start to end as of UNIX time now,
+        setting their alert flags
+        """
+
+        if end is None:
+            end = len(self.host)
+
+        gb = 1024.0 * 1024 * 1024
+        inf = float('inf')
+
+        # Thresholds by customer, as plain numbers for the loop below
+        limits = []
+        for c in self.custnames:
+            l = alertLimits(sets, c)
+            limits.append((
+                l['alertfreepercent'],
+                l['alertfreegb'] * gb,
+                now - l['alertstale'],
+                inf if l['alertusedgb'] is None else l['alertusedgb'] * gb,
+                -inf if l['alertdaysfull'] is None else l['alertdaysfull']
+                ))
+
+        (cust, alloc, free, used, lastcomplete, daysfull, flags) = (self.cust, self.alloc, self.free, self.used, self.lastcomplete, self.daysfull, self.flags)
+        for i in xrange(start, end):
+            (freepercent, freegb, stale, usedgb, daysleft) = limits[cust[i]]
+
+            bits = flags[i] & DUPLICATEBIT
+            if int((100 * int(free[i])) / int(alloc[i])) <= freepercent:
+                bits |= 0x01
+            if free[i] <= freegb:
+                bits |= 0x02
+            if used[i] >= usedgb:
+                bits |= 0x04
+            if lastcomplete[i] <= stale:
+                bits |= 0x08
+            if daysfull[i] <= daysleft:
+                bits |= 0x20
+            flags[i] = bits
+
+    def compact(self, keep):
+        """
+        Keep only the given rows (in the order given), renumbering them
+        from 0
+        """
+
+        old = dict((name, getattr(self, name)) for name in self.COLUMNS + ['cust', 'node', 'ratelimit', 'ratepercent', 'usedstate', 'fsshared', 'flags'])
+        host = self.host
+        self.clear()
+
+        for (name, column) in old.iteritems():
+            getattr(self, name).extend(column[i] for i in keep)
+        self.host.extend(host[i] for i in keep)
+
+    def alertList(self, i):
+        """
+        Return the alert texts for row i
+        """
+        return [text for (bit, text, item, label) in ALERTBITS if self.flags[i] & bit]
+
+    def key(self, i):
+        return (self.custnames[self.cust[i]], self.host[i])
+
+    def row(self, i):
+        """
+        Return (customer, host, hoststats) for row i, as used by the report
+        renderers
+        """
+
+        def value(number, unknown='n/a'):
+            if number != number:
+                return unknown
+            return int(number)
+
+        hstats = {
+            'alloc': int(self.alloc[i]),
+            'free': int(self.free[i]),
+            'freepercent': int((100 * int(self.free[i])) / int(self.alloc[i])),
+            'fsshared': bool(self.fsshared[i]),
+            'laststart': self.laststart[i] or False,
+            'lastcomplete': self.lastcomplete[i] or False,
+            'lastratelimit': str(self.ratelimit[i]),
+            'lastratepercent': str(self.ratepercent[i]),
+            'lastsent': value(self.lastsent[i]),
+            'growth': value(self.growth[i]),
+            'daysfull': value(self.daysfull[i]),
+            'ratetrend': value(self.ratetrend[i]),
+            'hostdisk': value(self.disk[i])
+        }
+
+        state = USEDSTATES[self.usedstate[i]]
+        hstats['hostused'] = value(self.used[i], 'pending' if state == 'pending' else 'n/a')
+        if state in ('pending', 'cached', 'estimate'):
+            hstats['usedstate'] = state
+        if state == 'estimate':
+            hstats['usedmargin'] = value(self.margin[i])
+            hstats['hostfiles'] = value(self.files[i])
+
+        if self.node[i]:
+            hstats['node'] = self.nodenames[self.node[i]]
+
+        for (bit, text, item, label) in ALERTBITS:
+            hstats[item] = bool(self.flags[i] & bit)
+        hstats['alertlist'] = self.alertList(i)
+        hstats['warnflag'] = bool(self.flags[i])
+
+        return (self.custnames[self.cust[i]], self.host[i], hstats)
+
+
+def reportColumns(aggregate=False):
+    """
+    Return the report column names - Aggregated reports add the node each
+    host was reported by
+    """
+
+    if aggregate:
+        return COLNAMES + ['Node']
+    return COLNAMES
+
+
+def reportRow(c, h, hstats, aggregate=False):
+    """
+    Return the raw (unformatted) report values for one host, in
+    reportColumns() order
+    """
+
+    if len(hstats['alertlist']):
+        alerttext = " ".join(hstats['alertlist'])
+    else:
+        alerttext = "OK"
+
+    return [
+        c,
+        h,
+        hstats['alloc'],
+        hstats['free'],
+        hstats['freepercent'],
+        hstats['hostused'],
+        timeString(hstats['laststart']),
+        timeString(hstats['lastcomplete']),
+        hstats['lastratelimit'],
+        hstats['lastratepercent'],
+        alerttext,
+        hstats['lastsent'],
+        hstats.get('growth', 'n/a'),
+        hstats.get('daysfull', 'n/a'),
+        hstats.get('ratetrend', 'n/a'),
+        hstats.get('usedmargin', 'n/a'),
+        hstats.get('hostdisk', 'n/a')
+    ] + ([hstats.get('node', 'n/a')] if aggregate else [])
+
+
+def metricsEscape(value):
+    """
+    Escape a label value for OpenMetrics exposition
+    """
+
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# Per-host gauges: (metric name, help, hoststats item)
+HOSTMETRICS = [
+    ('citoncync_host_allocated_bytes', 'Allocated bytes for the host filesystem or dataset', 'alloc'),
+    ('citoncync_host_free_bytes', 'Free bytes for the host filesystem or dataset', 'free'),
+    ('citoncync_host_used_bytes', 'Bytes used by the host folder', 'hostused'),
+    ('citoncync_host_used_margin_bytes', 'Margin (95% confidence) of an estimated host usage', 'usedmargin'),
+    ('citoncync_host_disk_bytes', 'Bytes allocated on disk to the host folder, each inode counted once', 'hostdisk'),
+    ('citoncync_host_last_start_timestamp_seconds', 'Start time of the last replication', 'laststart'),
+    ('citoncync_host_last_complete_timestamp_seconds', 'Completion time of the last replication', 'lastcomplete'),
+    ('citoncync_host_last_rate_limit_kbps', 'Upload rate limit of the last replication in Kbps', 'lastratelimit')
+]
+
+# Alert flags exported as citoncync_host_alert{alert=...} - Every alert bit
+HOSTALERTS = [(label, item) for (bit, text, item, label) in ALERTBITS]
+
+
+def metricsHostLines(c, h, hstats):
+    """
+    Return (metric family, exposition line) tuples for one host.  Values
+    that are unknown ('n/a', 'pending', never) are left out.  Aggregated
+    hosts are labelled with their node, since a host may be on several.
+    """
+
+    lines = []
+    labels = 'customer="%s",host="%s"' % (metricsEscape(c), metricsEscape(h))
+    if 'node' in hstats:
+        labels += ',node="%s"' % metricsEscape(hstats['node'])
+
+    for (name, helptext, item) in HOSTMETRICS:
+        value = hstats.get(item)
+        if value in (None, False, 'n/a', 'pending'):
+            continue
+        if isinstance(value, float):
+            # str() would round timestamps on Python 2
+            value = repr(value)
+        lines.append((name, '%s{%s} %s\n' % (name, labels, value)))
+
+    for (alert, item) in HOSTALERTS:
+        lines.append(('citoncync_host_alert', 'citoncync_host_alert{%s,alert="%s"} %d\n' % (labels, alert, 1 if hstats.get(item) else 0)))
+
+    return lines
+
+
+def metricsFamilies():
+    """
+    Return (metric family, header lines) tuples for the per-host metrics in
+    exposition order
+    """
+
+    families = []
+    for (name, helptext, item) in HOSTMETRICS:
+        families.append((name, "# TYPE %s gauge\n# HELP %s %s\n" % (name, name, helptext)))
+    families.append(('citoncync_host_alert', "# TYPE citoncync_host_alert gauge\n# HELP citoncync_host_alert Host alert flags (1 when raised)\n"))
+
+    return families
+
+
+def metricsRunLines(hosts, runstats):
+    """
+    Generate the self metrics and closing lines of an exposition
+    """
+
+    yield "# TYPE citoncync_hosts gauge\n"
+    yield "# HELP citoncync_hosts Hosts scanned\n"
+    yield "citoncync_hosts %d\n" % hosts
+
+    # Phase times only grow (over the daemon's life too), like the counts
+    yield "# TYPE citoncync_phase_seconds counter\n"
+    yield "# HELP citoncync_phase_seconds Wall time spent in each report phase\n"
+    for (phase, secs) in sorted(runstats.phases.items()):
+        yield 'citoncync_phase_seconds_total{phase="%s"} %.6f\n' % (phase, secs)
+
+    yield "# TYPE citoncync_calls counter\n"
+    yield "# HELP citoncync_calls Filesystem calls made\n"
+    for call in ['listdir', 'open', 'stat', 'statvfs']:
+        yield 'citoncync_calls_total{call="%s"} %d\n' % (call, runstats.counts.get(call, 0))
+
+    yield "# TYPE citoncync_visited counter\n"
+    yield "# HELP citoncync_visited Directories and files visited by usage walks\n"
+    for kind in ['dirs', 'files']:
+        yield 'citoncync_visited_total{kind="%s"} %d\n' % (kind, runstats.counts.get(kind, 0))
+
+    yield "# EOF\n"
+
+
+def renderMetrics(hostitems, runstats):
+    """
+    Generate OpenMetrics text exposition lines for a list of
+    (customer, host, hoststats) tuples plus the run's self metrics
+    """
+
+    byfamily = {}
+    for (c, h, hstats) in hostitems:
+        for (name, line) in metricsHostLines(c, h, hstats):
+            byfamily.setdefault(name, []).append(line)
+
+    for (name, header) in metricsFamilies():
+        yield header
+        for line in byfamily.get(name, []):
+            yield line
+
+    for line in metricsRunLines(len(hostitems), runstats):
+        yield line
+
+
+def writeAtomic(path, chunks):
+    """
+    Write an iterable of strings to path via a temp file in the same
+    directory renamed into place, so readers never see a partial file
+    """
+
+    tmppath = "%s.tmp.%d" % (path, os.getpid())
+    try:
+        fh = open(tmppath, 'w')
+        try:
+            fh.writelines(chunks)
+        finally:
+            fh.close()
+        os.rename(tmppath, path)
+    except:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+
+
+def reportText(c, h, hstats, history=False):
+    """
+    Return the plain text report block for one host - With history, the
+    growth and trend lines are included
+    """
+
+    if len(hstats['alertlist']):
+        alerttext = " ".join(hstats['alertlist'])
+    else:
+        alerttext = "OK"
+
+    hostused = hstats['hostused']
+    if hostused not in ('n/a', 'pending'):
+        hostused = humansize(hostused)
+    if hstats.get('usedstate') == 'cached':
+        hostused += " (cached)"
+    elif hstats.get('usedstate') == 'estimate':
+        hostused += " +/- %s (estimated, ~%d files)" % (humansize(hstats['usedmargin']), hstats['hostfiles'])
+    if hstats.get('hostdisk', 'n/a') != 'n/a':
+        hostused += " (%s on disk)" % humansize(hstats['hostdisk'])
+
+    lastsent = hstats['lastsent']
+    if lastsent != 'n/a':
+        lastsent = humansize(lastsent)
+
+    # Trend lines only mean something when history is being kept
+    trends = ""
+    if history:
+        growth = hstats.get('growth', 'n/a')
+        if growth != 'n/a':
+            growth = ("-" if growth < 0 else "") + humansize(abs(growth))
+        ratetrend = hstats.get('ratetrend', 'n/a')
+        if ratetrend != 'n/a':
+            ratetrend = "%s%%" % ratetrend
+        trends = "\tGrowth/Day: %s\n\tDays Until Full: %s\n\tRate Trend: %s\n" % (growth, hstats.get('daysfull', 'n/a'), ratetrend)
+
+    # Aggregated reports say which node the host lives on
+    node = ""
+    if 'node' in hstats:
+        node = "\tNode: %s\n" % hstats['node']
+
+    return "===============\n%s/%s\n%s\tAllocated/Free (Free%%): %s / %s (%s%%)\n\tHost Used: %s\n\tLast Replication Start Time: %s\n\tLast Completed Replication Time: %s\n\tLast Rate Limit (Rate%%): %sKbps (%s%%)\n\tLast Sent: %s\n%s\tSTATUS: %s\n==============\n\n\n" % (
+        c,
+        h,
+        node,
+        humansize(hstats['alloc']),
+        humansize(hstats['free']),
+        hstats['freepercent'],
+        hostused,
+        timeString(hstats['laststart']),
+        timeString(hstats['lastcomplete']),
+        hstats['lastratelimit'],
+        hstats['lastratepercent'],
+        lastsent,
+        trends,
+        alerttext
+        )
+
+
+def timeString(rawdate):
+    """
+    Take in a UNIX time and retrun a friendly time string, or "never" if false
+    """
+
+    try:
+        if rawdate:
+            stime = time.strftime(TIMEFORMAT, time.localtime(rawdate))
+        else:
+            stime = "never"
+    except:
+        return "never"
+
+    return stime
+
+
+class FsStats(object):
+    """
+    One statvfs snapshot of a filesystem, shared by every host on it
+    """
+
+    def __init__(self, mountpoint, sv):
+        self.mountpoint = mountpoint
+        self.alloc = sv.f_blocks * sv.f_frsize
+        self.free = sv.f_bfree * sv.f_frsize
+
+
+class FsStatsCache(object):
+    """
+    Hand out FsStats snapshots, taking only one statvfs per filesystem per
+    run.  Paths are mapped to filesystems through the mount table, or by
+    device number if no mount table is available.  Safe to share between
+    HostStatsPool workers.
+    """
+
+    def __init__(self, mounts=None):
+        """
+        Setup the cache with a set of mountpoints - Read from the system
+        mount table if not given
+        """
+
+        if mounts is None:
+            mounts = readMountTable()
+
+        self.mounts = mounts
+        self.filesystems = {}
+        self.lock = threading.Lock()
+
+    def mountFor(self, path):
+        """
+        Return the key for the filesystem holding path - The longest
+        matching mountpoint of its real (symlink resolved) location, or the
+        st_dev of path without a mount table
+        """
+
+        if not self.mounts:
+            return os.stat(path).st_dev
+
+        p = os.path.realpath(path)
+        while p not in self.mounts:
+            parent = os.path.dirname(p)
+            if parent == p:
+                break
+            p = parent
+
+        return p
+
+    def lookup(self, path):
+        """
+        Return the FsStats snapshot for the filesystem holding path
+        """
+
+        key = self.mountFor(path)
+
+        with self.lock:
+            fs = self.filesystems.get(key)
+            if fs is None:
+                RUNSTATS.count('statvfs')
+                fs = FsStats(key, os.statvfs(path))
+                self.filesystems[key] = fs
+
+        return fs
+
+
+class WalkUsageBackend(object):
+    """
+    Usage backend that walks every file under a host folder (optionally
+    helped by a persistent UsageIndex).  Works on any filesystem.
+    """
+
+    def __init__(self, sets):
+        self.sets = sets
+        self.budgeted = None    # hdir -> usage stats from budgetWalks()
+
+    def prepare(self):
+        """
+        Called once before any hosts are checked - Nothing to do for walks
+        """
+        pass
+
+    def needsWalk(self, hdir):
+        """
+        Return True if hostStats() would have to walk hdir
+        """
+        return not self.sets['skiphostused']
+
+    def budgetWalks(self, hostlist, fscache, pool, deadline):
+        """
+        Walk the given hosts in priority order until deadline, so hostStats()
+        can answer from the results.  Hosts on filesystems at or near their
+        free space alerts go first, then those with the oldest (or no)
+        completed walk.  Hosts not finished in time keep a checkpoint and
+        report their last completed usage flagged as 'cached', or 'pending'
+        if there is none.  The order only needs the index file times, so
+        each index is loaded when its walk starts and dropped after.
+        """
+
+        sets = self.sets
+        gb = 1024 * 1024 * 1024
+        queue = []
+        for (c, h, hdir) in hostlist:
+            if not self.needsWalk(hdir):
+                continue
+
+            fs = fscache.lookup(hdir)
+            limits = alertLimits(sets, c)
+            (freepercent, alertpercent, alertgb) = checkFreeAlerts(fs.alloc, fs.free, limits)
+            near = freepercent <= 2 * limits['alertfreepercent'] or fs.free <= 2 * limits['alertfreegb'] * gb
+
+            mtime = 0
+            if not sets['rebuildindex']:
+                try:
+                    mtime = os.path.getmtime(usageIndexPath(sets['indexdir'], sets['basepath'], hdir))
+                except OSError:
+                    pass
+            queue.append((not near, mtime, hdir))
+
+        queue.sort()
+
+        results = {}
+
+        def walk(item):
+            (far, mtime, hdir) = item
+            index = UsageIndex(usageIndexPath(sets['indexdir'], sets['basepath'], hdir), sets['rebuildindex'])
+            if time.time() >= deadline:
+                # Out of time before we started - Leave any checkpoint alone
+                used = None
+            else:
+                with pool.walkslot(hdir):
+                    used = getUsedSpace(hdir, index, deadline)
+                index.save()
+
+            if used is not None:
+                results[hdir] = {'hostused': used}
+            elif index.mtime is not None:
+                results[hdir] = {'hostused': index.cachedTotal(), 'usedstate': 'cached'}
+            else:
+                results[hdir] = {'hostused': 'pending', 'usedstate': 'pending'}
+
+        pool.each(queue, walk)
+        self.budgeted = results
+
+    def hostStats(self, hdir, walkslot=None):
+        """
+        Return a dictionary of usage stats for a single host directory
+        """
+
+        if self.sets['skiphostused']:
+            return {'hostused': 'n/a'}
+
+        if self.budgeted is not None:
+            return self.budgeted[hdir]
+
+        if self.sets['usageaccounting'] == 'unique':
+            tally = LinkTally(self.sets['linkspill'])
+            if walkslot is None:
+                (used, disk) = getUsedSpace(hdir, tally=tally)
+            else:
+                with walkslot:
+                    (used, disk) = getUsedSpace(hdir, tally=tally)
+
+            return {'hostused': used, 'hostdisk': disk}
+
+        if self.sets['estimateprobes']:
+            if walkslot is None:
+                (used, margin, files, exact) = estimateUsedSpace(hdir, self.sets['estimateprobes'])
+            else:
+                with walkslot:
+                    (used, margin, files, exact) = estimateUsedSpace(hdir, self.sets['estimateprobes'])
+
+            if exact:
+                return {'hostused': used}
+
+            # Only walk for real when the answer could flip the used alert,
+            # or when the probes did not vary enough to give a margin
+            limit = alertLimits(self.sets, os.path.relpath(hdir, self.sets['basepath']).split(os.sep)[0])['alertusedgb']
+            if margin is not None and (limit is None or not (used - margin <= limit * 1024 * 1024 * 1024 <= used + margin)):
+                return {'hostused': used, 'usedmargin': margin, 'hostfiles': files, 'usedstate': 'estimate'}
+
+        index = None
+        if self.sets['indexdir']:
+            index = UsageIndex(usageIndexPath(self.sets['indexdir'], self.sets['basepath'], hdir), self.sets['rebuildindex'])
+
+        if walkslot is None:
+            used = getUsedSpace(hdir, index)
+        else:
+            with walkslot:
+                used = getUsedSpace(hdir, index)
+
+        if index is not None:
+            index.save()
+
+        return {'hostused': used}
+
+    def refreshStats(self, hdir):
+        """
+        Return cheap-to-get alloc/free overrides for hdir, or None if the
+        backend has none.  Used by the daemon between full host checks.
+        """
+        return None
+
+
+class ZfsUsageBackend(WalkUsageBackend):
+    """
+    Usage backend that asks ZFS for used, available and quota on every
+    dataset under basepath with one bulk "zfs list" call.  Hosts that are
+    the mountpoint of their own dataset get exact numbers for free (even in
+    fast mode), with allocated space taken from the dataset quota or
+    used + available.  Any other host falls back to a walk.
+    """
+
+    def __init__(self, sets):
+        WalkUsageBackend.__init__(self, sets)
+        self.datasets = {}
+
+    def prepare(self):
+        """
+        Load used/available/quota for all datasets under basepath
+        """
+
+        cmd = shlex.split(self.sets['zfscmd']) + ['list', '-Hp', '-r', '-t', 'filesystem', '-o', 'name,mountpoint,used,available,quota', self.sets['basepath']]
+
+        try:
+            out = subprocess.check_output(cmd)
+        except (OSError, subprocess.CalledProcessError), err:
+            raise GeneralError("Unable to list ZFS datasets with '%s': %s" % (" ".join(cmd), err))
+
+        self.datasets = {}
+        for line in out.splitlines():
+            fields = line.split('\t')
+            if len(fields) != 5:
+                continue
+
+            (name, mountpoint, used, avail, quota) = fields
+
+            # Skip unmounted, legacy and otherwise unusable datasets
+            if not mountpoint.startswith('/'):
+                continue
+
+            try:
+                used = int(used)
+                avail = int(avail)
+            except ValueError:
+                continue
+
+            # No quota shows up as 0, - or none depending on ZFS version
+            try:
+                quota = int(quota)
+            except ValueError:
+                quota = 0
+
+            self.datasets[os.path.normpath(mountpoint)] = (used, avail, quota)
+
+    def needsWalk(self, hdir):
+        """
+        Only hosts that are not datasets of their own are walked
+        """
+        return os.path.normpath(hdir) not in self.datasets and WalkUsageBackend.needsWalk(self, hdir)
+
+    def hostStats(self, hdir, walkslot=None):
+        """
+        Return ZFS dataset stats for hdir, or walk if it is not a dataset
+        """
+
+        ds = self.datasets.get(os.path.normpath(hdir))
+        if ds is None:
+            return WalkUsageBackend.hostStats(self, hdir, walkslot)
+
+        (used, avail, quota) = ds
+        return {
+            'hostused': used,
+            'free': avail,
+            'alloc': quota or (used + avail)
+            }
+
+
+    def refreshStats(self, hdir):
+        """
+        Dataset numbers are already in memory - Hand them out
+        """
+
+        ds = self.datasets.get(os.path.normpath(hdir))
+        if ds is None:
+            return None
+
+        (used, avail, quota) = ds
+        return {'free': avail, 'alloc': quota or (used + avail)}
+
+
+# Available usage backends by config name
+USAGEBACKENDS = {
+    'walk': WalkUsageBackend,
+    'zfs': ZfsUsageBackend
+}
+
+
+class Configure(ConfigParser.ConfigParser):
+    """
+    Read and maintain configuration settings - Customized for this program.
+    All supported options must be filtered/copied in by this class
+    """
+
+    def __init__(self):
+        """
+        Read in configuration from command line and config file(s).  Stores
+        a cleaned dictionary called "settings" that should be usable without
+        further processing
+        """
+        ConfigParser.ConfigParser.__init__(self)
+
+        settings = {}
+
+        # Parse arguments - XXX - Move this to argparse soon
+        #  Great example of merged ConfigParser/argparse:
+        #  http://blog.vwelch.com/2011/04/combining-configparser-and-argparse.html
+        progname = os.path.basename(__file__)
+        parser = optparse.OptionParser(usage="%s [-c FILE] [-fmwvdr] [-j N] [--history DB] [--snapshot FILE | --aggregate SNAPSHOT...]" % progname)
+        parser.add_option("-c", "--config", dest="conffile", help="use configuration from FILE", metavar="FILE")
+        parser.add_option("-f", "--fast", dest="faston", action="store_true", default=False, help="skip per-host usage and other slow stats")
+        parser.add_option("-m", "--mail", dest="emailon", action="store_true", default=False, help="send email report")
+        parser.add_option("-w", "--warn", dest="warnonly", action="store_true", default=False, help="only report when there are hosts with low space or past due replication warnings")
+        parser.add_option("-v", "--csv", dest="csvon", action="store_true", default=False, help="output CSV report")
+        parser.add_option("-d", "--debug", dest="debugon", action="store_true", default=False, help="enable debug mode")
+        parser.add_option("-j", "--jobs", dest="jobs", type="int", default=1, help="collect stats for up to N hosts at once", metavar="N")
+        parser.add_option("-r", "--rebuild-index", dest="rebuildindex", action="store_true", default=False, help="ignore and rebuild the per-host usage index (see indexdir)")
+        parser.add_option("--history", dest="historydb", help="record stats in and report trends from SQLite database DB", metavar="DB")
+        parser.add_option("--daemon", dest="daemonon", action="store_true", default=False, help="run as a report server, refreshing hosts as they change")
+        parser.add_option("--listen", dest="listen", default="127.0.0.1:8631", help="serve daemon reports on ADDR:PORT (default %default)", metavar="ADDR:PORT")
+        parser.add_option("--metrics", dest="metricsfile", help="write OpenMetrics output to FILE (for a textfile collector)", metavar="FILE")
+        parser.add_option("--jsonl", dest="jsonlfile", help="also write the report as JSON Lines to FILE", metavar="FILE")
+        parser.add_option("--time-budget", dest="timebudget", type="int", help="spend at most SECONDS on usage walks, most urgent hosts first, resuming unfinished walks next run (needs indexdir)", metavar="SECONDS")
+        parser.add_option("--estimate", dest="estimateprobes", type="int", default=0, help="estimate host usage from N (at least %d) random probes instead of walking everything, walking only hosts near alertusedgb (estimates are not recorded as history, so give no growth trend)" % ESTIMATEDISTINCT, metavar="N")
+        parser.add_option("--profile", dest="profilefile", help="time every phase per host, print the slowest hosts and write full timings as JSON to FILE", metavar="FILE")
+        parser.add_option("--profile-top", dest="profiletop", type="int", default=10, help="number of slowest hosts to print with --profile (default %default)", metavar="N")
+        parser.add_option("--snapshot", dest="snapshotfile", help="agent mode - write collected stats to FILE for an aggregator instead of a report", metavar="FILE")
+        parser.add_option("--node", dest="node", default=platform.node(), help="node name to record in the snapshot (default %default)", metavar="NAME")
+        parser.add_option("--aggregate", dest="aggregateon", action="store_true", default=False, help="report on the snapshot files given as arguments instead of the local basepath")
+        parser.add_option("--dev-jobs", dest="devjobs", type="int", default=1, help="allow at most N concurrent usage walks per device (with --jobs)", metavar="N")
+
+        # Parse!
+        (options, args) = parser.parse_args()
+        
+        if options.conffile is None:
+            # No config passed, so try the default
+            conffile = CONFFILE
+        else:
+            conffile = options.conffile
+
+        if not os.path.isfile(conffile):
+            # This is just a quick check that the config file exists
+            parser.error("Configuration file %s not found" % conffile)
 
         try:
             # Read in configuration file
@@ -301,8 +2034,8 @@ class Configure(ConfigParser.ConfigParser):
         if not self.has_section('conf'):
             raise GeneralError("You MUST have a [conf] section! None found in %s\n" % conffile)
 
-        # The current config file setup only cares about the [conf] settings
-        # at this time.  It will be stored in the settings hash
+        # Settings come from the [conf] section, plus optional per-customer
+        # [customer:NAME] sections.  They are stored in the settings hash
 
         # Check for required settings under the [conf] section
         req = ['instancename', 'basepath', 'ignorecusts', 'dirmatch', 'bwtestfile', 'lastlogfile', 'alertfreepercent', 'alertfreegb', 'alertstale'] 
@@ -326,6 +2059,116 @@ class Configure(ConfigParser.ConfigParser):
         settings['warnonly'] = options.warnonly
         settings['debugon'] = options.debugon
         settings['csvon'] = options.csvon
+        settings['jobs'] = options.jobs
+        settings['devjobs'] = options.devjobs
+        settings['rebuildindex'] = options.rebuildindex
+        settings['historydb'] = options.historydb
+        settings['daemonon'] = options.daemonon
+        settings['metricsfile'] = options.metricsfile
+        settings['jsonlfile'] = options.jsonlfile
+        settings['profilefile'] = options.profilefile
+        settings['timebudget'] = options.timebudget
+        settings['estimateprobes'] = options.estimateprobes
+        settings['profiletop'] = options.profiletop
+        settings['listen'] = options.listen
+        settings['snapshotfile'] = options.snapshotfile
+        settings['node'] = options.node
+        settings['aggregateon'] = options.aggregateon
+        settings['snapshots'] = args
+
+        if settings['aggregateon']:
+            if not args:
+                parser.error("--aggregate needs one or more snapshot files")
+            if settings['snapshotfile'] or settings['daemonon']:
+                parser.error("--aggregate can not be used with --snapshot or --daemon")
+        elif args:
+            parser.error("Snapshot files are only read with --aggregate")
+
+        # History retention, trend window and "days until full" alerting
+        for (item, default) in [('historykeepdays', 90), ('historymaxdays', 1825), ('historywindow', 30), ('alertdaysfull', None), ('alertusedgb', None), ('daemonrefresh', 60), ('linkspill', LINKSPILL)]:
+            if self.has_option('conf', item):
+                try:
+                    settings[item] = int(self.get('conf', item))
+                except ValueError:
+                    raise GeneralError("'%s' must be a whole number" % item)
+            else:
+                settings[item] = default
+
+        # Per-customer alert threshold overrides from [customer:NAME] sections
+        settings['customers'] = {}
+        settings['customeremail'] = {}
+        for section in self.sections():
+            if not section.startswith('customer:'):
+                continue
+
+            # Customer recipients are kept apart from the thresholds
+            name = section[len('customer:'):].strip()
+            if self.has_option(section, 'emailto'):
+                settings['customeremail'][name] = [addr.strip() for addr in self.get(section, 'emailto').split(',')]
+
+            overrides = {}
+            for (item, convert) in [('alertfreepercent', int), ('alertfreegb', int), ('alertstale', float), ('alertusedgb', int), ('alertdaysfull', int)]:
+                if self.has_option(section, item):
+                    try:
+                        overrides[item] = convert(self.get(section, item))
+                    except ValueError:
+                        raise GeneralError("'%s' in [%s] must be a number" % (item, section))
+            settings['customers'][name] = overrides
+
+        # Run manifest written by newer clients - Defaults to sitting next
+        # to lastlogfile.  Set it empty to always read the log.
+        if self.has_option('conf', 'runmanifest'):
+            settings['runmanifest'] = self.get('conf', 'runmanifest').strip()
+        else:
+            settings['runmanifest'] = settings['lastlogfile'] + '.manifest'
+
+        # Optional persistent usage index location
+        if self.has_option('conf', 'indexdir'):
+            settings['indexdir'] = self.get('conf', 'indexdir')
+        else:
+            settings['indexdir'] = None
+
+        # Usage backend selection - Defaults to walking the filesystem
+        if self.has_option('conf', 'usagebackend'):
+            settings['usagebackend'] = self.get('conf', 'usagebackend').strip().lower()
+        else:
+            settings['usagebackend'] = 'walk'
+
+        if settings['usagebackend'] not in USAGEBACKENDS:
+            raise GeneralError("Unknown usagebackend '%s' - Use one of: %s" % (settings['usagebackend'], ", ".join(sorted(USAGEBACKENDS))))
+
+        # How walks add up host usage
+        if self.has_option('conf', 'usageaccounting'):
+            settings['usageaccounting'] = self.get('conf', 'usageaccounting').strip().lower()
+        else:
+            settings['usageaccounting'] = 'apparent'
+
+        if settings['usageaccounting'] not in ('apparent', 'unique'):
+            raise GeneralError("Unknown usageaccounting '%s' - Use apparent or unique" % settings['usageaccounting'])
+        if settings['linkspill'] < 1:
+            raise GeneralError("'linkspill' must be at least 1")
+
+        if self.has_option('conf', 'zfscmd'):
+            settings['zfscmd'] = self.get('conf', 'zfscmd')
+        else:
+            settings['zfscmd'] = 'zfs'
+
+        if settings['jobs'] < 1 or settings['devjobs'] < 1:
+            parser.error("--jobs and --dev-jobs must be at least 1")
+
+        if settings['estimateprobes'] < 0:
+            parser.error("--estimate needs a number of probes")
+        if 0 < settings['estimateprobes'] < ESTIMATEDISTINCT:
+            parser.error("--estimate needs at least %d probes to give an error margin" % ESTIMATEDISTINCT)
+        if settings['estimateprobes'] and settings['timebudget'] is not None:
+            parser.error("--estimate and --time-budget can not be used together")
+
+        if settings['usageaccounting'] == 'unique' and (settings['estimateprobes'] or settings['timebudget'] is not None):
+            parser.error("--estimate and --time-budget need usageaccounting = apparent")
+
+        # Unfinished walks are checkpointed alongside the usage index
+        if settings['timebudget'] is not None and not settings['indexdir']:
+            raise GeneralError("--time-budget needs 'indexdir' set in your configuration file")
 
         # Set other items based on the fast flag
         if settings['faston']:
@@ -362,33 +2205,242 @@ class Configure(ConfigParser.ConfigParser):
                 # Spit out all missing parameters at once
                 raise GeneralError(errs)
 
-            
-        # Save screened settings back to config 
-        self.settings = settings
+        # Optional spool directory for email that could not be delivered
+        if self.has_option('conf', 'mailspool'):
+            settings['mailspool'] = self.get('conf', 'mailspool')
+        else:
+            settings['mailspool'] = None
+            
+        # Save screened settings back to config 
+        self.settings = settings
+
+    def get_settings(self):
+        """
+        Return the stored settings dictionary
+        """
+        return self.settings
+
+    def boolcheck(self, value):
+        """
+        A more user-friendly True/False checker - Returns True on affirmative
+        including:
+         1
+         yes
+         YES
+         tRuE
+         Word
+         Si
+        All else is considered False
+        """
+
+        if re.match('^(1|yes|true|on|yo|si|word)$', value, re.IGNORECASE):
+            return True
+        else:
+            return False
+
+
+def buildMessage(fromaddr, toaddrs, subject, body):
+    """
+    Return a plain text email message
+    """
+
+    msg = email.Message.Message()
+    msg.add_header('From', fromaddr)
+    for t in toaddrs:
+        msg.add_header('To', t)
+    msg.add_header('Subject', subject)
+    msg.set_payload(body)
+
+    return msg
+
+
+class MailDelivery(object):
+    """
+    Deliver report email over one SMTP session for the whole run.  The
+    connection is opened on the first message and reused for the rest.  If
+    it drops it is reopened, up to retries times per message with a short
+    backoff.  Once retries run out the server is considered down for the
+    rest of the run.
+
+    With a spool directory, messages that could not be delivered because
+    the server was unreachable are saved there (one JSON file per message)
+    and sent by flushSpool() on a later run.  Without one, GeneralError is
+    raised.  A message the server rejects outright does not stop the run -
+    It is saved in failed/ under the spool directory (or dropped without
+    one) and noted in self.failed, as are spooled messages that can not be
+    read or are rejected.
+    """
+
+    def __init__(self, smtpserver, spooldir=None, retries=3):
+        self.smtpserver = smtpserver
+        self.spooldir = spooldir
+        self.retries = retries
+
+        self.server = None
+        self.down = False
+        self.sent = 0
+        self.spooled = 0
+        self.connects = 0
+        self.failed = []
+
+    def drop(self):
+        """
+        Forget the current connection, closing it if we can
+        """
+
+        if self.server is not None:
+            try:
+                self.server.close()
+            except (smtplib.SMTPException, socket.error):
+                pass
+        self.server = None
+
+    def deliver(self, fromaddr, toaddrs, text):
+        """
+        Send one message, reconnecting as needed.  Returns False if the
+        server could not be reached, and raises MailRejected if it refused
+        the message.
+        """
+
+        if self.down:
+            return False
+
+        for attempt in range(self.retries):
+            if attempt:
+                time.sleep(min(2 ** (attempt - 1), 10))
+            try:
+                if self.server is None:
+                    self.server = smtplib.SMTP(self.smtpserver)
+                    self.connects += 1
+                self.server.sendmail(fromaddr, toaddrs, text)
+                self.sent += 1
+                return True
+            except (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, socket.error), err:
+                self.drop()
+                lasterr = err
+            except smtplib.SMTPException, err:
+                raise MailRejected("Email report failure: %s" % err)
+
+        self.down = True
+        self.lasterr = lasterr
+        return False
+
+    def send(self, msg):
+        """
+        Send an email.Message, spooling it if the server can not be reached
+        and setting it aside if the server rejects it
+        """
+
+        try:
+            if self.deliver(msg['From'], msg.get_all('To'), msg.as_string()):
+                return
+        except MailRejected, err:
+            self.reject(msg['From'], msg.get_all('To'), msg.as_string(), str(err))
+            return
+
+        if self.spooldir is None:
+            raise GeneralError("Email report failure: %s" % self.lasterr)
+
+        self.spool(msg['From'], msg.get_all('To'), msg.as_string())
+
+    def spool(self, fromaddr, toaddrs, text):
+        """
+        Save a message for a later run
+        """
+
+        if not os.path.isdir(self.spooldir):
+            os.makedirs(self.spooldir)
+
+        self.spooled += 1
+        path = os.path.join(self.spooldir, "%.6f-%d-%d.msg" % (time.time(), os.getpid(), self.spooled))
+        try:
+            writeAtomic(path, [json.dumps({'from': fromaddr, 'to': toaddrs, 'message': text})])
+        except (IOError, OSError), err:
+            raise GeneralError("Unable to spool email to %s: %s" % (path, err))
+
+    def reject(self, fromaddr, toaddrs, text, reason):
+        """
+        Note a message the server refused, keeping a copy in failed/ under
+        the spool directory if there is one
+        """
 
-    def get_settings(self):
+        desc = "Email to %s rejected - %s" % (", ".join(toaddrs), reason)
+        if self.spooldir is not None:
+            faileddir = os.path.join(self.spooldir, 'failed')
+            path = os.path.join(faileddir, "%.6f-%d-%d.msg" % (time.time(), os.getpid(), len(self.failed)))
+            try:
+                if not os.path.isdir(faileddir):
+                    os.makedirs(faileddir)
+                writeAtomic(path, [json.dumps({'from': fromaddr, 'to': toaddrs, 'message': text})])
+            except (IOError, OSError), err:
+                raise GeneralError("Unable to save rejected email to %s: %s" % (path, err))
+            desc += " (saved as %s)" % path
+        self.failed.append(desc)
+
+    def takeFailed(self):
         """
-        Return the stored settings dictionary
+        Return and clear the notes on messages set aside so far
         """
-        return self.settings
 
-    def boolcheck(self, value):
+        (failed, self.failed) = (self.failed, [])
+        return failed
+
+    def flushSpool(self):
         """
-        A more user-friendly True/False checker - Returns True on affirmative
-        including:
-         1
-         yes
-         YES
-         tRuE
-         Word
-         Si
-        All else is considered False
+        Send messages spooled by earlier runs, oldest first, stopping if
+        the server can not be reached.  A message that can not be read or
+        is rejected is set aside in failed/ so it does not block the rest,
+        and noted in self.failed.  Returns the number sent.
         """
 
-        if re.match('^(1|yes|true|on|yo|si|word)$', value, re.IGNORECASE):
-            return True
-        else:
-            return False
+        if self.spooldir is None or not os.path.isdir(self.spooldir):
+            return 0
+
+        sent = 0
+        for name in sorted(os.listdir(self.spooldir)):
+            if not name.endswith(".msg"):
+                continue
+
+            path = os.path.join(self.spooldir, name)
+            try:
+                with open(path) as fh:
+                    spooled = json.load(fh)
+                delivered = self.deliver(spooled['from'], spooled['to'], spooled['message'].encode('utf-8'))
+            except (IOError, ValueError, KeyError, TypeError, AttributeError), err:
+                self.setAside(path, "unreadable: %s" % err)
+                continue
+            except GeneralError, err:
+                self.setAside(path, str(err))
+                continue
+
+            if not delivered:
+                break
+            os.remove(path)
+            sent += 1
+
+        return sent
+
+    def setAside(self, path, reason):
+        """
+        Move a spooled message that can not be sent into failed/
+        """
+
+        faileddir = os.path.join(self.spooldir, 'failed')
+        try:
+            if not os.path.isdir(faileddir):
+                os.makedirs(faileddir)
+            os.rename(path, os.path.join(faileddir, os.path.basename(path)))
+        except OSError, err:
+            raise GeneralError("Unable to set aside spooled email %s: %s" % (path, err))
+        self.failed.append("Spooled email %s moved to failed/ - %s" % (path, reason))
+
+    def close(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except (smtplib.SMTPException, socket.error):
+                pass
+            self.server = None
 
 
 class EmailReportHandler(logging.Handler):
@@ -396,11 +2448,11 @@ class EmailReportHandler(logging.Handler):
     Buffer and generate email reports
     """
 
-    def __init__(self, smtpserver, fromaddr, toaddrs, subjectprefix):
+    def __init__(self, delivery, fromaddr, toaddrs, subjectprefix):
         """
         Setup email reporter:
 
-         smtpserver - Hostname or IP of SMTP relay
+         delivery - MailDelivery to send through
          fromaddr - String with email address of sender
          toaddrs - Array of email addresses to send to
          subjectprefix - Common prefix to prepend to all subject lines
@@ -408,13 +2460,13 @@ class EmailReportHandler(logging.Handler):
 
         logging.Handler.__init__(self)
 
-        self.smtpserver = smtpserver
+        self.delivery = delivery
         self.fromaddr = fromaddr
         self.toaddrs = toaddrs
         self.subjectprefix = subjectprefix
 
         # Start with an empty buffer and a NOTSET (0) level high water mark
-        self.buf = ""
+        self.buf = []
         self.maxlevel = 0
         self.starttime = time.strftime("%Y-%m-%d %H:%M:%S")
 
@@ -424,8 +2476,9 @@ class EmailReportHandler(logging.Handler):
         which would ship the message immediately on an emit)
         """
 
-        # Save the text
-        self.buf += self.format(record) + "\r\n"
+        # Save the text - Joined once at send time
+        self.buf.append(self.format(record))
+        self.buf.append("\r\n")
 
         # Update our high water mark for collected messages
         if record.levelno > self.maxlevel: self.maxlevel = record.levelno
@@ -439,9 +2492,7 @@ class EmailReportHandler(logging.Handler):
         # with the collected logs
         body += "\r\nStart Time: %s" % self.starttime
         body += "\r\nEnd Time  : %s" % time.strftime("%Y-%m-%d %H:%M:%S") 
-        body += "\r\n\r\n" + self.buf
-
-        msg = email.Message.Message()
+        body += "\r\n\r\n" + "".join(self.buf)
 
         # Check maximum level and add a special note in the subject for anything
         # above INFO
@@ -450,25 +2501,862 @@ class EmailReportHandler(logging.Handler):
         else:
             notice = ""
 
-        # Build our message header
-        msg.add_header('From', self.fromaddr)
-        for t in self.toaddrs:
-            msg.add_header('To', t)
-        msg.add_header('Subject', "%s %s %s" % (self.subjectprefix, notice, subject))
-        msg.set_payload(body)
-
         # Fire!
+        self.delivery.send(buildMessage(self.fromaddr, self.toaddrs, "%s %s %s" % (self.subjectprefix, notice, subject), body))
+
+
+class HistoryDB(object):
+    """
+    SQLite store of per-host stats from every run, used to compute growth
+    and throughput trends as hosts stream through.  Samples are kept at full resolution for
+    keepdays, then downsampled to one per host per week, then dropped after
+    maxdays.
+    """
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS hosts (
+            id INTEGER PRIMARY KEY,
+            customer TEXT NOT NULL,
+            host TEXT NOT NULL,
+            UNIQUE (customer, host))""",
+        """CREATE TABLE IF NOT EXISTS samples (
+            hostid INTEGER NOT NULL REFERENCES hosts (id),
+            runtime REAL NOT NULL,
+            alloc INTEGER,
+            free INTEGER,
+            used INTEGER,
+            ratekbps INTEGER,
+            lastcomplete REAL,
+            PRIMARY KEY (hostid, runtime))""",
+        """CREATE INDEX IF NOT EXISTS samples_runtime ON samples (runtime)"""
+    ]
+
+    WEEK = 7 * 86400
+    BATCH = 500     # Samples per executemany
+
+    def __init__(self, path, keepdays=90, maxdays=1825, window=30):
+        """
+        Open (creating if needed) the history database at path:
+
+         keepdays - Days to keep every sample before downsampling to weekly
+         maxdays - Days to keep any sample at all
+         window - Days of samples to fit trends over
+        """
+
+        self.keepdays = keepdays
+        self.maxdays = maxdays
+        self.window = window
+        self.pending = []
+
         try:
-            server = smtplib.SMTP(self.smtpserver)
-            
-            # server.set_debuglevel(1)
+            self.db = sqlite3.connect(path)
+            for sql in self.SCHEMA:
+                self.db.execute(sql)
+            self.db.commit()
+        except sqlite3.Error, err:
+            raise GeneralError("Unable to open history database %s: %s" % (path, err))
+
+    def hostId(self, c, h):
+        """
+        Return the id for a customer/host, adding it if missing.  Runs
+        inside the current transaction.
+        """
+
+        self.db.execute("INSERT OR IGNORE INTO hosts (customer, host) VALUES (?, ?)", (c, h))
+
+        return self.db.execute("SELECT id FROM hosts WHERE customer = ? AND host = ?", (c, h)).fetchone()[0]
+
+    def add(self, c, h, runtime, hstats):
+        """
+        Queue one sample for a host and return its trend dictionary with:
+
+         growth - Host used bytes per day (None if unknown)
+         daysfull - Days until the host's filesystem fills at the current
+                    rate (None if not filling)
+         ratetrend - Percent change of this rate limit from the window
+                     average (None if unknown)
+
+        Trends are least squares fits over the trend window.  The sums are
+        done in SQL over earlier samples (one indexed range on the
+        (hostid, runtime) key), with the new sample added in here, so
+        samples can be inserted in batches.  Nothing is committed until
+        close().
+        """
+
+        try:
+            hostid = self.hostId(c, h)
+
+            since = runtime - (self.window * 86400)
+            sums = self.db.execute("""SELECT
+                COUNT(*), SUM(t), SUM(t * t),
+                COUNT(used), SUM(CASE WHEN used IS NULL THEN NULL ELSE t END),
+                SUM(CASE WHEN used IS NULL THEN NULL ELSE t * t END),
+                SUM(used), SUM(t * used),
+                SUM(alloc - free), SUM(t * (alloc - free)),
+                COUNT(ratekbps), SUM(ratekbps), MIN(t)
+                FROM (SELECT (runtime - ?) / 86400.0 AS t, alloc, free, used, ratekbps
+                      FROM samples WHERE hostid = ? AND runtime >= ? AND runtime < ?)""", (since, hostid, since, runtime)).fetchone()
+        except sqlite3.Error, err:
+            raise GeneralError("Unable to read history: %s" % err)
+
+        (n, st, stt, nu, stu, sttu, su, stuy, sa, sta, nr, sr, mint) = [v or 0 for v in sums]
+
+        # Only freshly walked usage makes a sample
+        used = hstats['hostused'] if hstats['hostused'] != 'n/a' and not hstats.get('usedstate') else None
+        try:
+            rate = int(hstats['lastratelimit'])
+        except ValueError:
+            rate = None
+
+        self.pending.append((hostid, runtime, hstats['alloc'], hstats['free'], used, rate, hstats['lastcomplete'] or None))
+        if len(self.pending) >= self.BATCH:
+            self.flush()
+
+        # Add this sample at the end of the window
+        t = float(self.window)
+        (n, st, stt) = (n + 1, st + t, stt + (t * t))
+        (sa, sta) = (sa + (hstats['alloc'] - hstats['free']), sta + (t * (hstats['alloc'] - hstats['free'])))
+        if used is not None:
+            (nu, stu, sttu, su, stuy) = (nu + 1, stu + t, sttu + (t * t), su + used, stuy + (t * used))
+
+        # Samples must cover at least a day before a slope means anything
+        span = (self.window - mint) if n else 0
+
+        def slope(n, st, stt, sy, sty):
+            d = (n * stt) - (st * st)
+            if n < 2 or not d or span < 1:
+                return None
+            return ((n * sty) - (st * sy)) / d
+
+        growth = None
+        if used is not None:
+            growth = slope(nu, stu, sttu, su, stuy)
+
+        daysfull = None
+        fill = slope(n, st, stt, sa, sta)
+        if fill and fill > 0:
+            daysfull = hstats['free'] / fill
+
+        ratetrend = None
+        if rate is not None and nr:
+            avgrate = float(sr + rate) / (nr + 1)
+            if avgrate:
+                ratetrend = (100.0 * (rate - avgrate)) / avgrate
+
+        return {'growth': growth, 'daysfull': daysfull, 'ratetrend': ratetrend}
+
+    def flush(self):
+        """
+        Insert queued samples in one batch
+        """
+
+        try:
+            self.db.executemany("INSERT OR REPLACE INTO samples VALUES (?, ?, ?, ?, ?, ?, ?)", self.pending)
+        except sqlite3.Error, err:
+            raise GeneralError("Unable to record history: %s" % err)
+
+        self.pending = []
+
+    def prune(self, runtime):
+        """
+        Downsample samples older than keepdays to the last one per host per
+        week and drop samples older than maxdays.  Only the last couple of
+        weeks before the cutoff can still need downsampling, so older
+        (already weekly) rows are not rescanned every run.
+        """
+
+        cutoff = runtime - (self.keepdays * 86400)
+        since = (int(cutoff - (2 * self.WEEK)) // self.WEEK) * self.WEEK
+
+        self.db.execute("""DELETE FROM samples WHERE runtime >= ? AND runtime < ? AND rowid NOT IN (
+            SELECT MAX(rowid) FROM samples WHERE runtime >= ? AND runtime < ?
+            GROUP BY hostid, CAST(runtime / ? AS INTEGER))""", (since, cutoff, since, cutoff, self.WEEK))
+        self.db.execute("DELETE FROM samples WHERE runtime < ?", (runtime - (self.maxdays * 86400),))
+
+    def commit(self, runtime):
+        """
+        Write out any queued samples, apply the retention policy and commit
+        the whole run
+        """
+
+        self.flush()
+        try:
+            self.prune(runtime)
+            self.db.commit()
+        except sqlite3.Error, err:
+            raise GeneralError("Unable to record history: %s" % err)
+
+    def close(self):
+        self.db.close()
+
+
+class HostStatsPool(object):
+    """
+    Bounded worker pool for collecting host stats concurrently.  Most of the
+    time spent on a host is waiting on disk I/O, so plain threads work well
+    here.  The number of in-flight usage walks against any one device
+    (st_dev - One per ZFS dataset or mounted filesystem) is capped separately
+    so a single busy pool is not hammered by every worker at once.
+    """
+
+    def __init__(self, jobs, devjobs):
+        """
+        Setup the pool:
+
+         jobs - Maximum number of hosts to collect at once
+         devjobs - Maximum number of concurrent usage walks per device
+        """
+
+        self.jobs = max(1, jobs)
+        self.devjobs = max(1, devjobs)
+
+        # Per-device walk semaphores, created on first use
+        self.devslots = {}
+        self.devlock = threading.Lock()
+
+    def walkslot(self, hdir):
+        """
+        Return the walk semaphore for the device holding hdir
+        """
+
+        try:
+            dev = os.stat(hdir).st_dev
+        except os.error, err:
+            dev = None
+
+        with self.devlock:
+            if dev not in self.devslots:
+                self.devslots[dev] = threading.BoundedSemaphore(self.devjobs)
+            return self.devslots[dev]
+
+    def each(self, items, func):
+        """
+        Call func(item) for every item, up to jobs at a time, in no
+        particular order of completion.  Items are started in the order
+        given.  Any exception raised by func is re-raised here.
+        """
+
+        if self.jobs == 1:
+            for item in items:
+                func(item)
+            return
+
+        todo = Queue.Queue()
+        for item in items:
+            todo.put(item)
+        errors = []
+
+        def worker():
+            while not errors:
+                try:
+                    item = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    func(item)
+                except:
+                    errors.append(sys.exc_info())
+
+        workers = [threading.Thread(target=worker, name="hostwalk-%d" % i) for i in range(self.jobs)]
+        for t in workers:
+            t.daemon = True
+            t.start()
+        for t in workers:
+            t.join()
+
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+
+    def run(self, hostlist, sets, backend, fscache):
+        """
+        Collect stats for every (customer, host, hdir) tuple in hostlist
+        using the given (prepared) usage backend and FsStatsCache.  Yields
+        (customer, host, hoststats) tuples in hostlist order.  Finished
+        hosts wait in a reorder buffer until all hosts before them are done,
+        and only a window of jobs * 4 hosts is ever in flight or buffered,
+        so memory stays bounded however many hosts there are.  Any exception
+        raised by a worker is re-raised here.
+        """
+
+        # Serial mode - Skip the threads entirely
+        if self.jobs == 1:
+            for (c, h, hdir) in hostlist:
+                with RUNSTATS.host(c, h):
+                    hstats = getHostStats(hdir, sets, backend, fscache)
+                yield (c, h, hstats)
+            return
+
+        todo = Queue.Queue()
+        done = Queue.Queue()
+        items = enumerate(hostlist)
+
+        def feed():
+            for item in items:
+                todo.put(item)
+                return 1
+            return 0
+
+        def worker():
+            while True:
+                item = todo.get()
+                if item is None:
+                    return
+
+                (i, (c, h, hdir)) = item
+                try:
+                    with RUNSTATS.host(c, h):
+                        hstats = getHostStats(hdir, sets, backend, fscache, self.walkslot(hdir))
+                    done.put((i, c, h, hstats, None))
+                except:
+                    done.put((i, c, h, None, sys.exc_info()))
+
+        workers = []
+        for i in range(self.jobs):
+            t = threading.Thread(target=worker, name="hoststats-%d" % i)
+            t.daemon = True
+            t.start()
+            workers.append(t)
+
+        try:
+            inflight = 0
+            for i in range(self.jobs * 4):
+                inflight += feed()
+
+            finished = {}
+            nexti = 0
+            while inflight:
+                (i, c, h, hstats, excinfo) = done.get()
+                inflight -= 1
+                if excinfo:
+                    raise excinfo[0], excinfo[1], excinfo[2]
+
+                finished[i] = (c, h, hstats)
+                while nexti in finished:
+                    yield finished.pop(nexti)
+                    nexti += 1
+                    inflight += feed()
+        finally:
+            # Let the workers finish before returning, so none are left
+            # blocked in the queue at interpreter shutdown
+            for t in workers:
+                todo.put(None)
+            for t in workers:
+                t.join()
+
+
+def csvLine(row):
+    """
+    Return one CSV formatted line, without the line ending
+    """
+
+    out = StringIO.StringIO()
+    csv.writer(out).writerow(row)
+    return out.getvalue().rstrip("\r\n")
+
+
+class LogSink(object):
+    """
+    Report sink writing plain text or CSV lines through the logger (and so
+    to the console and email report).  Alert lines go out as warnings.
+    """
+
+    def __init__(self, logger, csvon, history=False, aggregate=False):
+        self.logger = logger
+        self.csvon = csvon
+        self.history = history
+        self.aggregate = aggregate
+        self.warnings = 0
+
+        # Force out a header if CSV is enabled
+        if self.csvon:
+            self.logger.info(csvLine(reportColumns(aggregate)))
+
+    def write(self, c, h, hstats):
+        # Build our output to be plain text or CSV
+        self.logger.debug("Generating Report Line for %s/%s" % (c, h))
+        if self.csvon:
+            oline = csvLine(reportRow(c, h, hstats, self.aggregate))
+        else:
+            oline = reportText(c, h, hstats, self.history)
+
+        # Push the host results using info for normal lines or
+        # warning for alert lines
+        if hstats['warnflag']:
+            self.logger.warning(oline)
+            self.warnings += 1
+        else:
+            self.logger.info(oline)
+
+    def close(self):
+        pass
+
+
+class CustomerMailSink(object):
+    """
+    Report sink sending each customer with its own recipients (emailto in
+    a [customer:NAME] section) a report of just their hosts.  Hosts arrive
+    sorted by customer, so each customer's report goes out as soon as the
+    next customer starts.
+    """
+
+    def __init__(self, sets, delivery):
+        self.sets = sets
+        self.delivery = delivery
+        self.recipients = sets['customeremail']
+
+        self.customer = None
+        self.buf = []
+        self.hosts = 0
+        self.warnings = 0
+
+    def write(self, c, h, hstats):
+        if c != self.customer:
+            self.finish()
+            self.customer = c
+            if self.sets['csvon'] and c in self.recipients:
+                self.buf.append(csvLine(reportColumns(self.sets['aggregateon'])) + "\r\n")
+
+        if c not in self.recipients:
+            return
+
+        if self.sets['csvon']:
+            self.buf.append(csvLine(reportRow(c, h, hstats, self.sets['aggregateon'])) + "\r\n")
+        else:
+            self.buf.append(reportText(c, h, hstats, bool(self.sets['historydb'])).replace("\n", "\r\n"))
+
+        self.hosts += 1
+        if hstats['warnflag']:
+            self.warnings += 1
+
+    def finish(self):
+        """
+        Send the report for the current customer, if it has recipients
+        (and warnings, with -w)
+        """
+
+        c = self.customer
+        if c in self.recipients and self.hosts and (self.warnings or not self.sets['warnonly']):
+            if self.warnings:
+                subject = "%s Report for %s - %d of %d hosts with warnings" % (self.sets['instancename'], c, self.warnings, self.hosts)
+            else:
+                subject = "%s Report for %s - All %d hosts ok" % (self.sets['instancename'], c, self.hosts)
+            body = "".join(self.buf) + "\r\nReport Time: %s\r\n" % time.strftime(TIMEFORMAT)
+
+            with RUNSTATS.phase('email'):
+                self.delivery.send(buildMessage(self.sets['emailfrom'], self.recipients[c], subject, body))
+
+        self.customer = None
+        self.buf = []
+        self.hosts = 0
+        self.warnings = 0
+
+    def close(self):
+        self.finish()
 
-            server.sendmail(msg['From'], msg.get_all('To'), msg.as_string())
-            server.quit()
-        except Exception, err:
-            raise GeneralError("Email report failure: %s" % err)
 
+class JsonLinesSink(object):
+    """
+    Report sink writing one JSON object per host to a file, which is
+    renamed into place when the report is complete
+    """
+
+    def __init__(self, path, aggregate=False):
+        self.path = path
+        self.tmppath = "%s.tmp.%d" % (path, os.getpid())
+        self.columns = reportColumns(aggregate)
+        self.aggregate = aggregate
+        try:
+            self.fh = open(self.tmppath, 'w')
+        except IOError, err:
+            raise GeneralError("Unable to write JSON report to %s: %s" % (path, err))
+
+    def write(self, c, h, hstats):
+        self.fh.write(json.dumps(dict(zip(self.columns, reportRow(c, h, hstats, self.aggregate)))))
+        self.fh.write("\n")
+
+    def close(self):
+        self.fh.close()
+        os.rename(self.tmppath, self.path)
+
+
+class SnapshotSink(object):
+    """
+    Report sink for agent mode.  Writes the collected (not evaluated) stats
+    for every host as gzipped JSON lines - A header line naming the node
+    followed by one [customer, host, stats] record per host in report order
+    - for an aggregator to merge.  Alerts are left to the aggregator so all
+    nodes are judged by one set of thresholds.
+    """
+
+    # Collected items - Everything else in the host stats is derived
+    KEYS = ['alloc', 'free', 'fsshared', 'hostused', 'usedstate', 'usedmargin', 'hostfiles', 'hostdisk', 'laststart', 'lastcomplete', 'lastratelimit', 'lastratepercent', 'lastsent']
+
+    def __init__(self, path, node, runtime):
+        self.path = path
+        self.tmppath = "%s.tmp.%d" % (path, os.getpid())
+        try:
+            self.fh = gzip.open(self.tmppath, 'wb')
+            self.fh.write(json.dumps({'snapshot': SNAPSHOTVERSION, 'node': node, 'time': runtime}))
+            self.fh.write("\n")
+        except IOError, err:
+            raise GeneralError("Unable to write snapshot to %s: %s" % (path, err))
+
+    def write(self, c, h, hstats):
+        self.fh.write(json.dumps([c, h, dict((k, hstats[k]) for k in self.KEYS if k in hstats)], separators=(',', ':')))
+        self.fh.write("\n")
+
+    def close(self):
+        self.fh.close()
+        os.rename(self.tmppath, self.path)
+
+
+def readSnapshot(path):
+    """
+    Yield (customer, host, node, stats) for each host in an agent snapshot,
+    in the sorted order the agent wrote them
+    """
+
+    try:
+        fh = gzip.open(path, 'rb')
+        try:
+            header = json.loads(fh.readline())
+            if not isinstance(header, dict) or header.get('snapshot') != SNAPSHOTVERSION:
+                raise GeneralError("%s is not a version %d snapshot" % (path, SNAPSHOTVERSION))
+            node = header['node']
+
+            last = None
+            for line in fh:
+                (c, h, hstats) = json.loads(line)
+                if last is not None and (c, h) < last:
+                    raise GeneralError("Snapshot %s is not in report order at %s/%s" % (path, c, h))
+                last = (c, h)
+                yield (c, h, node, hstats)
+        finally:
+            fh.close()
+    except (IOError, ValueError, KeyError, zlib.error), err:
+        raise GeneralError("Unable to read snapshot %s: %s" % (path, err))
+
+
+def mergeSnapshots(paths):
+    """
+    Merge agent snapshots into one report ordered stream.  Yields
+    (customer, host, [(node, stats), ...]) with more than one entry when
+    the same customer/host was reported by several nodes.  Only one record
+    per snapshot is held in memory at a time.
+    """
+
+    merged = heapq.merge(*[readSnapshot(path) for path in paths])
+    for ((c, h), group) in itertools.groupby(merged, lambda rec: (rec[0], rec[1])):
+        yield (c, h, [(node, hstats) for (gc, gh, node, hstats) in group])
+
+
+class MetricsSink(object):
+    """
+    Report sink for OpenMetrics output.  Each metric family's lines are
+    spooled to its own temp file as hosts stream through, since a family's
+    samples must be contiguous, then stitched together and renamed into
+    place by close().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.hosts = 0
+        self.families = metricsFamilies()
+        self.spools = dict((name, tempfile.TemporaryFile()) for (name, header) in self.families)
+
+    def write(self, c, h, hstats):
+        self.hosts += 1
+        for (name, line) in metricsHostLines(c, h, hstats):
+            self.spools[name].write(line)
+
+    def chunks(self, runstats):
+        for (name, header) in self.families:
+            yield header
+            spool = self.spools[name]
+            spool.seek(0)
+            for chunk in iter(lambda: spool.read(65536), ''):
+                yield chunk
+            spool.close()
+
+        for line in metricsRunLines(self.hosts, runstats):
+            yield line
+
+    def close(self, runstats=RUNSTATS):
+        try:
+            writeAtomic(self.path, self.chunks(runstats))
+        except (IOError, OSError), err:
+            raise GeneralError("Unable to write metrics to %s: %s" % (self.path, err))
+
+
+class ReportDaemon(object):
+    """
+    Long running report server.  Keeps every host's stats in memory, fully
+    rechecking a host only when its bwtestfile, lastlogfile or run manifest
+    changes (seen with inotify when pyinotify is available, else by polling
+    the mtimes of those files).  Filesystem numbers are refreshed from one
+    statvfs per filesystem on a timer and alerts are re-evaluated every
+    tick.  The current report is served over local HTTP as JSON
+    (/report.json) and CSV (/report.csv).
+    """
+
+    def __init__(self, sets, logger):
+        self.sets = sets
+        self.logger = logger
+
+        self.table = HostTable()
+        self.rowof = {}         # (customer, host) -> table row
+        self.hostdirs = {}      # (customer, host) -> host directory
+        self.watched = {}       # watched directory -> (customer, host)
+        self.stamps = {}        # (customer, host) -> watched file mtimes
+        self.dirty = set()      # Hosts waiting for a full check
+        self.lock = threading.Lock()
+
+        self.backend = USAGEBACKENDS[sets['usagebackend']](sets)
+        self.pool = HostStatsPool(sets['jobs'], sets['devjobs'])
+
+        self.wm = None
+        if pyinotify is not None:
+            self.wm = pyinotify.WatchManager()
+            self.notifier = pyinotify.ThreadedNotifier(self.wm, self.onEvent)
+            self.notifier.daemon = True
+            self.notifier.start()
+
+    def watchFiles(self, hdir):
+        """
+        Return the files that signal a new replication run for a host
+        """
+
+        files = [os.path.join(hdir, self.sets['bwtestfile']), os.path.join(hdir, self.sets['lastlogfile'])]
+        if self.sets['runmanifest']:
+            files.append(os.path.join(hdir, self.sets['runmanifest']))
+        return files
+
+    def runStamp(self, hdir):
+        """
+        Return the mtimes of the host's watched files
+        """
+
+        return tuple(getLastChange(hdir, f) for f in self.watchFiles(hdir))
+
+    def onEvent(self, event):
+        """
+        inotify callback - Flag the host owning the changed file
+        """
+
+        key = self.watched.get(event.path)
+        if key is not None:
+            with self.lock:
+                self.dirty.add(key)
+
+    def watch(self, key, hdir):
+        """
+        Add inotify watches on the directories holding the host's watched
+        files.  These are watched rather than the files themselves since
+        rsync replaces files by renaming over them.
+        """
+
+        if self.wm is None:
+            return
+
+        mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | pyinotify.IN_CREATE | pyinotify.IN_ATTRIB
+        for f in self.watchFiles(hdir):
+            d = os.path.dirname(f)
+            if d not in self.watched and os.path.isdir(d):
+                self.wm.add_watch(d, mask, quiet=True)
+                self.watched[d] = key
+
+    def scanHosts(self):
+        """
+        Pick up new and removed customer/host directories.  New hosts are
+        flagged for a full check.
+        """
+
+        found = {}
+        for c in listCustomers(self.sets['basepath'], self.sets['dirmatch'], self.sets['ignorecusts']):
+            for h in listCustomerHosts(self.sets['basepath'], c, self.sets['dirmatch']):
+                found[(c, h)] = os.path.join(self.sets['basepath'], c, h)
+
+        with self.lock:
+            gone = set(self.hostdirs) - set(found)
+            for key in gone:
+                self.dirty.discard(key)
+                self.stamps.pop(key, None)
+
+            if gone & set(self.rowof):
+                self.table.compact(sorted(i for (key, i) in self.rowof.iteritems() if key not in gone))
+                self.rowof = dict((self.table.key(i), i) for i in xrange(len(self.table)))
+
+            for key in set(found) - set(self.hostdirs):
+                self.dirty.add(key)
+            self.hostdirs = found
+
+        for (key, hdir) in found.iteritems():
+            self.watch(key, hdir)
+
+    def pollHosts(self):
+        """
+        Without inotify, flag hosts whose watched files changed mtime
+        """
+
+        for (key, i) in self.rowof.items():
+            hdir = self.hostdirs[key]
+            if self.runStamp(hdir) != self.stamps.get(key):
+                with self.lock:
+                    self.dirty.add(key)
 
+    def refresh(self):
+        """
+        One daemon tick - Fully recheck flagged hosts, refresh filesystem
+        numbers for everyone else, then re-evaluate all alerts
+        """
+
+        now = time.time()
+
+        self.scanHosts()
+        if self.wm is None:
+            self.pollHosts()
+
+        self.backend.prepare()
+        fscache = FsStatsCache()
+
+        with self.lock:
+            todo = sorted(self.dirty)
+            self.dirty = set()
+
+        hostlist = [(c, h, self.hostdirs[(c, h)]) for (c, h) in todo if (c, h) in self.hostdirs]
+        for (c, h, hdir) in hostlist:
+            self.stamps[(c, h)] = self.runStamp(hdir)
+        added = set()
+        for (c, h, hstats) in self.pool.run(hostlist, self.sets, self.backend, fscache):
+            self.logger.debug("Refreshed stats for %s/%s" % (c, h))
+            with self.lock:
+                if (c, h) in self.hostdirs:
+                    # Rechecked hosts keep their alert flags to spot changes
+                    if (c, h) in self.rowof:
+                        self.table.set(self.rowof[(c, h)], hstats)
+                    else:
+                        self.rowof[(c, h)] = self.table.append(c, h, hstats)
+                        added.add((c, h))
+
+        todo = set(todo)
+        with self.lock:
+            for (key, i) in self.rowof.iteritems():
+                if key not in todo:
+                    hdir = self.hostdirs[key]
+                    if self.table.fsshared[i]:
+                        fs = fscache.lookup(hdir)
+                        (self.table.alloc[i], self.table.free[i]) = (fs.alloc, fs.free)
+                    else:
+                        override = self.backend.refreshStats(hdir)
+                        if override is not None:
+                            (self.table.alloc[i], self.table.free[i]) = (override['alloc'], override['free'])
+
+            oldflags = array.array('B', self.table.flags)
+            self.table.evaluate(self.sets, now)
+
+            for (key, i) in self.rowof.iteritems():
+                if key not in added and oldflags[i] != self.table.flags[i]:
+                    self.logger.warning("%s/%s status changed: %s" % (key[0], key[1], " ".join(self.table.alertList(i)) or "OK"))
+
+    def rows(self):
+        """
+        Return the current report rows in sorted customer/host order
+        """
+
+        with self.lock:
+            return [reportRow(*self.table.row(self.rowof[key])) for key in sorted(self.rowof)]
+
+    def renderJson(self):
+        return json.dumps([dict(zip(COLNAMES, row)) for row in self.rows()], indent=1)
+
+    def renderMetrics(self):
+        with self.lock:
+            hostitems = [self.table.row(self.rowof[key]) for key in sorted(self.rowof)]
+        return "".join(renderMetrics(hostitems, RUNSTATS))
+
+    def renderCsv(self):
+        out = StringIO.StringIO()
+        writer = csv.writer(out)
+        writer.writerow(COLNAMES)
+        writer.writerows(self.rows())
+        return out.getvalue()
+
+    def serve(self, listen, interval):
+        """
+        Start the HTTP server on listen (host:port) and refresh every
+        interval seconds.  Does not return.
+        """
+
+        (addr, port) = listen.rsplit(':', 1)
+        try:
+            httpd = ReportHTTPServer((addr, int(port)), ReportHTTPHandler)
+        except (ValueError, socket.error), err:
+            raise GeneralError("Unable to listen on %s: %s" % (listen, err))
+        httpd.reportdaemon = self
+
+        t = threading.Thread(target=httpd.serve_forever, name="httpd")
+        t.daemon = True
+        t.start()
+        self.logger.info("Serving reports on http://%s/report.json, /report.csv and /metrics" % listen)
+
+        while True:
+            self.refresh()
+            time.sleep(interval)
+
+
+class ReportHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Threaded HTTP server for ReportDaemon
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class ReportHTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serve ReportDaemon reports
+    """
+
+    def do_GET(self):
+        rd = self.server.reportdaemon
+        path = self.path.split('?', 1)[0]
+
+        if path in ('/', '/report.json'):
+            (ctype, body) = ('application/json', rd.renderJson())
+        elif path == '/report.csv':
+            (ctype, body) = ('text/csv', rd.renderCsv())
+        elif path == '/metrics':
+            (ctype, body) = ('application/openmetrics-text; version=1.0.0; charset=utf-8', rd.renderMetrics())
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """
+        Keep request logging out of the report output
+        """
+        pass
+
+
+def aggregateResults(sets):
+    """
+    Yield (customer, host, stats) from merged agent snapshots, in report
+    order.  The reporting node is recorded in the stats and hosts seen on
+    more than one node carry the other node names in 'dupnodes'.
+    """
+
+    for (c, h, entries) in mergeSnapshots(sets['snapshots']):
+        nodes = [node for (node, hstats) in entries]
+        for (node, hstats) in entries:
+            hstats['node'] = node
+            hstats['dupnodes'] = [other for other in nodes if other != node]
+            yield (c, h, hstats)
 
 
 class Error(Exception):
@@ -491,6 +3379,14 @@ class GeneralError(Error):
         return self.msg
 
 
+class MailRejected(GeneralError):
+    """
+    The SMTP server refused a message - Unlike an unreachable server, this
+    only affects that one message
+    """
+    pass
+
+
 def main ():
 
     # Report time
@@ -503,6 +3399,9 @@ def main ():
     sets = conf.get_settings()
 
 
+    # Per-host profiling is off unless asked for
+    RUNSTATS.profiling = bool(sets['profilefile'])
+
     # Setup base logger and formatting
     logger = logging.getLogger('CitonCync-RepReport')
     logger.setLevel(sets['loglevel'])
@@ -518,142 +3417,174 @@ def main ():
     # Custom EmailReport handler - Designed to collect all messages and send
     # one blast at the end
     if sets['emailon']:
-        elog = EmailReportHandler(sets['smtpserver'], sets['emailfrom'], sets['emailto'], "%s" % sets['instancename'])
+        delivery = MailDelivery(sets['smtpserver'], sets['mailspool'])
+        elog = EmailReportHandler(delivery, sets['emailfrom'], sets['emailto'], "%s" % sets['instancename'])
         elog.setFormatter(format)
         logger.addHandler(elog)
 
     
-    r = {}
-    warnings = 0
     hosts = 0
 
     # Wrap in try to catch exceptions using our custom classes
 
     try:
-        # Cycle through customer/hostname directories
-        logger.debug("Starting processing under %s" % sets['basepath'])
-        for c in listCustomers(sets['basepath'], sets['dirmatch'], sets['ignorecusts']):
-            r[c] = {}
-            logger.debug("Processing customer %s" % c)
-        
-            for h in listCustomerHosts(sets['basepath'], c, sets['dirmatch']):
-                r[c][h] = {}
-                hosts += 1
-                hdir = os.path.join(sets['basepath'], c, h)
-                logger.debug("Checking stats for %s/%s" % (c, h))
-
-                # Gather stats
-                r[c][h]['alloc'] = getAllocSpace(hdir)
-                r[c][h]['free'] = getFreeSpace(hdir)
-                r[c][h]['freepercent'] = int((100 * r[c][h]['free']) / r[c][h]['alloc'])
-                if sets['skiphostused']:
-                    r[c][h]['hostused'] = 'n/a'
-                else:
-                    r[c][h]['hostused'] = getUsedSpace(hdir)
-
-                r[c][h]['laststart'] = getLastChange(hdir, sets['bwtestfile'])
-                r[c][h]['lastcomplete'] = getLastChange(hdir, sets['lastlogfile'])
-                (r[c][h]['lastratelimit'], r[c][h]['lastratepercent']) = getLastRate(hdir, sets['lastlogfile'])
-                
-                # Clear warn flag
-                r[c][h]['warnflag'] = False
-                alertlist = []
-                logger.debug("Checking alerts")
-                
-                # Test for percentage of disk space free
-                if r[c][h]['freepercent'] <= int(sets['alertfreepercent']):
-                    r[c][h]['alertfreepercent'] = True
-                    r[c][h]['warnflag'] = True
-                    alertlist.append("ALERT-FREE%")
-                    logger.debug("Free Percent Failure for %s/%s" % (c, h))
-                else:
-                    r[c][h]['alertfreepercent'] = False
-
-                # Test for absolute disk space free in GB
-                if r[c][h]['free'] <= (int(sets['alertfreegb']) * 1024 * 1024 * 1024):
-                    r[c][h]['alertfreegb'] = True
-                    r[c][h]['warnflag'] = True
-                    alertlist.append("ALERT-FREE-GB")
-                    logger.debug("Free GB Failure for %s/%s" % (c, h))
-                else:
-                    r[c][h]['alertfreegb'] = False
-            
-                # Test for staleness of last replication completion
-                if (r[c][h]['lastcomplete'] and (r[c][h]['lastcomplete'] > (proctime - float(sets['alertstale'])))):
-                    r[c][h]['alertstale']  = False
-                else:
-                    r[c][h]['alertstale']  = True
-                    r[c][h]['warnflag'] = True
-                    alertlist.append("ALERT-LATE")
-                    logger.debug("Staleness Failure for %s/%s" % (c, h))
+        if sets['daemonon']:
+            ReportDaemon(sets, logger).serve(sets['listen'], sets['daemonrefresh'])
 
-                r[c][h]['alertlist'] = alertlist
+        if sets['aggregateon']:
+            # Hosts come from agent snapshots rather than the local basepath
+            logger.debug("Aggregating %s" % ", ".join(sets['snapshots']))
+            results = aggregateResults(sets)
+        else:
+            # Cycle through customer/hostname directories, in report order
+            logger.debug("Starting processing under %s" % sets['basepath'])
+            hostlist = []
+            with RUNSTATS.phase('list'):
+                for c in sorted(listCustomers(sets['basepath'], sets['dirmatch'], sets['ignorecusts'])):
+                    logger.debug("Processing customer %s" % c)
+            
+                    for h in sorted(listCustomerHosts(sets['basepath'], c, sets['dirmatch'])):
+                        hostlist.append((c, h, os.path.join(sets['basepath'], c, h)))
+
+            # Setup our usage backend - This may do a bulk query up front
+            with RUNSTATS.phase('collect'):
+                backend = USAGEBACKENDS[sets['usagebackend']](sets)
+                backend.prepare()
+
+            # One statvfs snapshot per filesystem for the whole run
+            fscache = FsStatsCache()
+            pool = HostStatsPool(sets['jobs'], sets['devjobs'])
+
+            # Most urgent usage walks first, for as long as we are allowed
+            if sets['timebudget'] is not None and not sets['skiphostused']:
+                with RUNSTATS.phase('walk'):
+                    backend.budgetWalks(hostlist, fscache, pool, proctime + sets['timebudget'])
+
+            # Gather stats - Possibly several hosts at once
+            results = pool.run(hostlist, sets, backend, fscache)
+
+        history = None
+        if sets['historydb']:
+            logger.debug("Recording history in %s" % sets['historydb'])
+            history = HistoryDB(sets['historydb'], sets['historykeepdays'], sets['historymaxdays'], sets['historywindow'])
+
+        # Where finished hosts go - Agents only write their snapshot
+        if sets['snapshotfile']:
+            logsink = None
+            sinks = [SnapshotSink(sets['snapshotfile'], sets['node'], proctime)]
+        else:
+            logsink = LogSink(logger, sets['csvon'], bool(sets['historydb']), sets['aggregateon'])
+            sinks = [logsink]
+        if sets['jsonlfile']:
+            sinks.append(JsonLinesSink(sets['jsonlfile'], sets['aggregateon']))
+
+        # Customers with their own recipients get their own reports.  Mail
+        # left over from earlier runs goes out first.
+        if sets['emailon'] and logsink is not None:
+            with RUNSTATS.phase('email'):
+                spooled = delivery.flushSpool()
+            if spooled:
+                logger.debug("Sent %d spooled email(s)" % spooled)
+            for note in delivery.takeFailed():
+                logger.warning(note)
+            if sets['customeremail']:
+                sinks.append(CustomerMailSink(sets, delivery))
+        metricsink = None
+        if sets['metricsfile']:
+            metricsink = MetricsSink(sets['metricsfile'])
+
+        # Hosts are collected into blocks of up to BLOCKSIZE rows, which
+        # are evaluated in one pass and written out before the next block
+        table = HostTable()
+
+        def flush():
+            with RUNSTATS.phase('evaluate'):
+                table.evaluate(sets, proctime)
+
+            for i in xrange(len(table)):
+                (c, h, hstats) = table.row(i)
+                if hstats['warnflag']:
+                    logger.debug("Alerts for %s/%s: %s" % (c, h, " ".join(hstats['alertlist'])))
+                with RUNSTATS.host(c, h), RUNSTATS.phase('render'):
+                    for sink in sinks:
+                        sink.write(c, h, hstats)
+                    if metricsink is not None:
+                        metricsink.write(c, h, hstats)
+
+            table.clear()
+
+        while True:
+            with RUNSTATS.phase('collect'):
+                try:
+                    (c, h, hstats) = next(results)
+                except StopIteration:
+                    break
+
+            hosts += 1
+            logger.debug("Collected stats for %s/%s" % (c, h))
+
+            # The same customer/host replicating to more than one node
+            if hstats.get('dupnodes'):
+                logger.debug("Duplicate Failure for %s/%s - Also on %s" % (c, h, ", ".join(hstats['dupnodes'])))
+
+            # Record this host and pull its trends from the history database
+            if history is not None:
+                with RUNSTATS.phase('history'):
+                    hstats.update(history.add(c, h, proctime, hstats))
+
+            table.append(c, h, hstats)
+            if len(table) >= BLOCKSIZE:
+                flush()
+
+        flush()
+
+        for sink in sinks:
+            sink.close()
+
+        if history is not None:
+            with RUNSTATS.phase('history'):
+                history.commit(proctime)
+                history.close()
+
+        # Agents leave reporting to the aggregator
+        if logsink is None:
+            logger.info("Wrote snapshot of %d hosts to %s" % (hosts, sets['snapshotfile']))
+            warnings = 0
+        else:
+            warnings = logsink.warnings
 
-                
-        # Force out a header if CSV is enabled
-        if sets['csvon']:
-            logger.info(','.join(COLNAMES))
-
-        # Now cycle through customers and hosts in order and build our report
-        for c in sorted(r.iterkeys()):
-            for h in sorted(r[c].iterkeys()):
-                # Build our output to be plain text or CSV
-                logger.debug("Generating Report Line for %s/%s" % (c, h))
-                if len(r[c][h]['alertlist']):
-                    alerttext = " ".join(r[c][h]['alertlist'])
-                else:
-                    alerttext = "OK"
-                    
-                if sets['csvon']:
-                    oline = '%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s' % (
-                        c,
-                        h,
-                        r[c][h]['alloc'],
-                        r[c][h]['free'],
-                        r[c][h]['freepercent'],
-                        r[c][h]['hostused'],
-                        timeString(r[c][h]['laststart']),
-                        timeString(r[c][h]['lastcomplete']),
-                        r[c][h]['lastratelimit'],
-                        r[c][h]['lastratepercent'],
-                        alerttext
-                        )
-                else:
-                    r[c][h]['alloc'] = humansize(r[c][h]['alloc'])
-                    r[c][h]['free'] = humansize(r[c][h]['free'])
-                    if not sets['skiphostused']:
-                        r[c][h]['hostused'] =  humansize(r[c][h]['hostused'])
-                        
-                    oline = "===============\n%s/%s\n\tAllocated/Free (Free%%): %s / %s (%s%%)\n\tHost Used: %s\n\tLast Replication Start Time: %s\n\tLast Completed Replication Time: %s\n\tLast Rate Limit (Rate%%): %sKbps (%s%%)\n\tSTATUS: %s\n==============\n\n\n" % (
-                        c,
-                        h,
-                        r[c][h]['alloc'],
-                        r[c][h]['free'],
-                        r[c][h]['freepercent'],
-                        r[c][h]['hostused'],
-                        timeString(r[c][h]['laststart']),
-                            timeString(r[c][h]['lastcomplete']),
-                        r[c][h]['lastratelimit'],
-                        r[c][h]['lastratepercent'],
-                        alerttext
-                        )
-                
-                # Push the host results using info for normal lines or
-                # warning for alert lines
-                if r[c][h]['warnflag']:
-                    logger.warning(oline)
-                    warnings += 1
-                else:
-                    logger.info(oline)
-                    
-                    
         # Send email if enabled and warranted
-        if sets['emailon']:
-            if warnings:
-                elog.send(": %s hosts checked [%s WARNING(S)] (%s)" % (str(hosts), str(warnings), time.strftime(TIMEFORMAT)), "%s Report - %s of %s hosts with warnings" % (sets['instancename'], str(warnings), str(hosts)))
-            else:
-                if not sets['warnonly']:
-                    elog.send(": %s hosts checked [ALL OK] (%s)" % (str(hosts), time.strftime(TIMEFORMAT)), "%s Report - All %s hosts ok" % (sets['instancename'], str(hosts)))
+        if sets['emailon'] and logsink is not None:
+            # Customer reports refused by the server go in the main report
+            for note in delivery.takeFailed():
+                logger.warning(note)
+
+            with RUNSTATS.phase('email'):
+                if warnings:
+                    elog.send(": %s hosts checked [%s WARNING(S)] (%s)" % (str(hosts), str(warnings), time.strftime(TIMEFORMAT)), "%s Report - %s of %s hosts with warnings" % (sets['instancename'], str(warnings), str(hosts)))
+                else:
+                    if not sets['warnonly']:
+                        elog.send(": %s hosts checked [ALL OK] (%s)" % (str(hosts), time.strftime(TIMEFORMAT)), "%s Report - All %s hosts ok" % (sets['instancename'], str(hosts)))
+
+                delivery.close()
+
+            logger.debug("Email: %d sent over %d connection(s), %d spooled" % (delivery.sent, delivery.connects, delivery.spooled))
+            if delivery.spooled:
+                logger.warning("Unable to reach %s - %d email(s) spooled in %s for the next run" % (sets['smtpserver'], delivery.spooled, sets['mailspool']))
+            for note in delivery.takeFailed():
+                logger.warning(note)
+
+        # Metrics and profiles go out last so they include every phase
+        if metricsink is not None:
+            metricsink.close(RUNSTATS)
+
+        if sets['profilefile']:
+            # Straight to the console - This is not part of the report
+            print >> sys.stderr, "\nSlowest %d hosts (seconds):\n%s" % (sets['profiletop'], RUNSTATS.topHosts(sets['profiletop']))
+            try:
+                writeAtomic(sets['profilefile'], [json.dumps(RUNSTATS.profile(), indent=1, sort_keys=True)])
+            except (IOError, OSError), err:
+                raise GeneralError("Unable to write profile to %s: %s" % (sets['profilefile'], err))
     
     
     except GeneralError as detail: